@@ -0,0 +1,87 @@
+from typing import Union
+
+import array
+import json
+import mmap
+import os
+import struct
+
+
+class ArrayFile(object):
+    """
+    A file of named, typed arrays which is memory-mapped rather than read into memory.
+    Lookups only touch the pages of the file they need, so even large files open instantly
+    and several processes reading the same file share a single copy of it in the page cache.
+
+    The file comprises a signature, the length of a json header, the header itself and then the arrays.
+    The header holds the type code, offset and length of each array together with any metadata supplied by the writer.
+    Each array is aligned on an eight byte boundary so that it can be cast directly to its type.
+    """
+    SIGNATURE = b'NPADBARR'
+    ALIGNMENT = 8
+
+    def __init__(self, filepath: str):
+        """
+        :param filepath:
+        :raises FileNotFoundError: if the file does not exist
+        :raises ValueError: if the file is not an array file
+        """
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(self.SIGNATURE)] != self.SIGNATURE:
+            self.map.close()
+            raise ValueError(f'{filepath} is not an array file')
+        start = len(self.SIGNATURE) + 4
+        (header_length, ) = struct.unpack('<I', self.map[len(self.SIGNATURE):start])
+        header = json.loads(self.map[start:start + header_length].decode('utf-8'))
+        self.metadata = header['metadata']
+        self.arrays = {}
+        view = memoryview(self.map)
+        for (name, (type_code, offset, length)) in header['arrays'].items():
+            item_size = struct.calcsize(type_code)
+            self.arrays[name] = view[offset:offset + length * item_size].cast(type_code)
+
+    def __getitem__(self, name: str) -> memoryview:
+        return self.arrays[name]
+
+    def close(self):
+        for item in self.arrays.values():
+            item.release()
+        self.arrays = {}
+        self.map.close()
+
+    @classmethod
+    def write(cls, filepath: str, arrays: dict, metadata: Union[dict, None] = None):
+        """
+        Write the arrays to a new file.
+        The file is written under a temporary name and then moved into place
+        so that anyone with the old file mapped can carry on using it.
+        :param filepath:
+        :param arrays: A dict of array.array objects (or bytes, which are stored as unsigned chars) keyed by name
+        :param metadata: Anything else, serializable as json, that the reader will need
+        """
+        arrays = {name: (a if isinstance(a, array.array) else array.array('B', a)) for (name, a) in arrays.items()}
+        header = {'metadata': metadata or {}, 'arrays': {}}
+        # The header's length depends on the offsets it contains so leave room for the largest possible offsets
+        header['arrays'] = {name: [a.typecode, 2 ** 63, 2 ** 63] for (name, a) in arrays.items()}
+        offset = cls.aligned(len(cls.SIGNATURE) + 4 + len(json.dumps(header).encode('utf-8')))
+        for (name, a) in arrays.items():
+            header['arrays'][name] = [a.typecode, offset, len(a)]
+            offset = cls.aligned(offset + len(a) * a.itemsize)
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        temporary_filepath = f'{filepath}.tmp'
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(temporary_filepath, 'wb') as f:
+            f.write(cls.SIGNATURE)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            for (name, a) in arrays.items():
+                f.seek(header['arrays'][name][1])
+                a.tofile(f)
+        os.replace(temporary_filepath, filepath)
+
+    @classmethod
+    def aligned(cls, offset: int) -> int:
+        return (offset + cls.ALIGNMENT - 1) // cls.ALIGNMENT * cls.ALIGNMENT
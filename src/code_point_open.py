@@ -1,12 +1,110 @@
-from src.environment import MyEnvironment
+from src.environment import MyEnvironment, WorkerEnvironment
 from src.exceptions import CodePointOpenError
+from src.district_boundaries import DistrictBoundaries
 from mysql.connector.cursor import MySQLCursor
-from mysql.connector.errors import Error as MySQLError
-from typing import Tuple
+from mysql.connector.errors import DataError, IntegrityError
+from typing import Iterable, Iterator, Tuple, Union
 
+import collections
+import io
+import multiprocessing
+import multiprocessing.util
 import os
 import re
 import csv
+import zipfile
+
+
+class CodePointOpenDirectory(object):
+    """
+    An edition of Code Point Open which has been unpacked into a directory of csv files, one per post code area.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def filenames(self) -> list:
+        return [entry.name for entry in os.scandir(self.path)]
+
+    def open(self, filename: str):
+        """
+        :raises FileNotFoundError: if there is no such file in the edition
+        """
+        return open(os.path.join(self.path, filename), newline='')
+
+
+class CodePointOpenArchive(object):
+    """
+    An edition of Code Point Open read directly from the zip archive in which OS distributes it.
+    Nothing is extracted to disk: each area file is decompressed and decoded as it is read.
+    """
+    MEMBER_PATTERN = r'(?:.*/)?Data/CSV/([^/]+\.csv)'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.members = {}
+        for name in self.archive.namelist():
+            match = re.fullmatch(self.MEMBER_PATTERN, name, re.IGNORECASE)
+            if match:
+                self.members[match.group(1).lower()] = name
+
+    def __str__(self):
+        return self.path
+
+    def filenames(self) -> list:
+        return list(self.members.keys())
+
+    def open(self, filename: str):
+        """
+        :raises FileNotFoundError: if there is no such file in the edition
+        """
+        try:
+            member = self.members[filename.lower()]
+        except KeyError:
+            raise FileNotFoundError(filename)
+        return io.TextIOWrapper(self.archive.open(member), newline='')
+
+
+class RejectSink(object):
+    """
+    The records of a post code area which are rejected during a build are written to a tab-separated file,
+    one file per area, in a directory alongside the edition so that they can be inspected and reprocessed later.
+    Only the number of rejects for each reason is reported to the console.
+    """
+    UNKNOWN_DISTRICT = 'Unknown district code'
+    OUTSIDE_SPLIT_DISTRICTS = 'Outside split district boundaries'
+    DATABASE_ERROR = 'Database error'
+    HEADERS = ['reason', 'post_code', 'osx', 'osy', 'gr_source_id', 'gss_admin_area_code', 'detail']
+
+    def __init__(self, directory: str, post_code_area: str):
+        self.filepath = os.path.join(directory, f'{post_code_area.lower()}.tsv')
+        self.file = None
+        self.writer = None
+        self.reasons = collections.Counter()
+        # Any rejects from an earlier build of the area are out of date
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
+
+    def add(self, reason: str, post_code: str, osx, osy, gr_source_id, gss_code: str, detail: str = ''):
+        """
+        Record a rejected post code.
+        The file is only created when the area's first reject is recorded.
+        """
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            self.file = open(self.filepath, 'w', newline='')
+            self.writer = csv.writer(self.file, delimiter='\t')
+            self.writer.writerow(self.HEADERS)
+        self.writer.writerow([reason, post_code, osx, osy, gr_source_id, gss_code, detail])
+        self.reasons[reason] += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
 
 
 class CodePointOpen(object):
@@ -24,19 +122,63 @@ class CodePointOpen(object):
         'TS22': 2610,
         'TS23': 2610
     }
+    # Split administrative areas whose post codes are divided by outward code
+    # when the split district boundaries file does not cover them
+    OUTWARD_CODE_DIVISIONS = {
+        'E06000004': STOCKTON_DIVISIONS  # Stockton-on-Tees
+    }
+    SPLIT_DISTRICTS_FILENAME = 'split-districts.json'
     EDITION_PATTERN = r'20[0-9]{2}-(02|05|08|11)'
+    SHADOW_TABLE = 'post_codes_new'
+    FALLBACK_TABLE = 'post_codes_old'
+    INSERT_STATEMENT = 'insert into {} values (%s, %s, %s, %s, %s)'
+    UPSERT_STATEMENT = INSERT_STATEMENT.format('post_codes') + (
+        ' on duplicate key update osx = values(osx), osy = values(osy),'
+        ' gr_source_id = values(gr_source_id), district_id = values(district_id)'
+    )
+    DELETE_STATEMENT = 'delete from post_codes where post_code in ({})'
+    CHECKPOINT_TABLE = 'post_code_build_checkpoints'
 
-    def __init__(self, env: MyEnvironment):
+    def __init__(self, env: Union[MyEnvironment, WorkerEnvironment]):
         self.env = env
-        (self.edition, self.data_root) = self.verified_edition()
+        (self.edition, self.source) = self.verified_edition(self.env.args.edition)
+        if self.env.args.update_from is None:
+            (self.previous_edition, self.previous_source) = (None, None)
+        else:
+            (self.previous_edition, self.previous_source) = self.verified_edition(self.env.args.update_from)
+        self.batch_size = self.env.args.batch_size
+        self.jobs = self.env.args.jobs
+        self.rejects_root = os.path.join(
+            self.env.external_data_root,
+            'gazetteer',
+            f'os-code-point-open-{self.edition}-rejects'
+        )
+
+        # With the --shadow option, the table is built as post_codes_new and swapped in when complete
+        if self.env.args.shadow and not self.env.args.all:
+            raise CodePointOpenError('The --shadow option can only be used with --all')
+        self.table_name = self.SHADOW_TABLE if self.env.args.shadow else 'post_codes'
+        self.insert_statement = self.INSERT_STATEMENT.format(self.table_name)
+        self.secondary_indexes = {}
+        self.foreign_keys = {}
+
+        # With the --resume option, areas completed by an interrupted --all build of the edition are skipped
+        if self.env.args.resume and not self.env.args.all:
+            raise CodePointOpenError('The --resume option can only be used with --all')
+        self.completed_areas = {}
 
         # Counting variables
         self.area_count = 0
         self.total_record_count = 0
+        self.total_rejects = collections.Counter()
+        self.total_changes = collections.Counter()
 
         # Cache the gss_admin_area_codes in a dict rather than perform millions of individual db lookups.
         self.gss_codes = self.fetched_gss_codes()
 
+        # Post codes in administrative areas split between districts are assigned by location
+        self.boundaries = self.loaded_district_boundaries()
+
     def import_post_code_data(self):
         """
         The main build process
@@ -44,72 +186,372 @@ class CodePointOpen(object):
         # Display the process title
         if not self.env.args.quiet:
             print('** Build post_codes Table **')
-        self.env.msg.debug(self.data_root)
+        self.env.msg.debug(str(self.source))
 
         # If the --all option is set, truncate the existing post_codes table
+        # or, with the --shadow option, leave it alone and start an empty copy of it instead.
+        # Neither is done when resuming an interrupted build: the areas it completed are kept.
         if self.env.args.all:
+            self.prepare_checkpoints()
+        if len(self.completed_areas) > 0:
+            self.tally_completed_areas()
+            if self.env.args.shadow:
+                self.secondary_indexes = self.fetched_secondary_indexes()
+                self.foreign_keys = self.fetched_foreign_keys()
+        elif self.env.args.shadow:
+            self.create_shadow_table()
+        elif self.env.args.all:
             q = "truncate table post_codes"
             c = self.env.dbc.cursor()
             c.execute(q)
             self.env.dbc.commit()
             c.close()
 
-        for filename in self.data_files():
-            post_code_area = filename.split('.')[0].upper()
-            try:
-                area_record_count, area_error_count = self.process_csv_file(post_code_area, filename)
-            except FileNotFoundError:
-                w = [
-                    f'Skipping Post Code Area "{post_code_area}":',
-                    f'>>File {filename} not found'
-                ]
-                self.env.msg.warning(w)
-            else:
-                self.area_count += 1
-                self.total_record_count += area_record_count
-                self.env.msg.ok(f'Processed {area_record_count:,} records in Post Code Area "{post_code_area}"')
-                if area_error_count > 0:
-                    self.env.msg.warning(
-                        f'Records skipped in Post Code area {post_code_area} because of errors: {area_error_count:,}'
-                    )
+        if self.jobs > 1:
+            results = self.parallel_area_results()
+        else:
+            results = (self.processed_area(filename) for filename in self.data_files())
+        for result in results:
+            self.tally_area(*result)
 
+        if self.env.args.shadow:
+            self.swap_shadow_table()
+        if self.env.args.all:
+            self.clear_checkpoints()
+        self.refresh_snapshot()
         self.final_overview()
 
-    def verified_edition(self) -> Tuple[str, str]:
+    def refresh_snapshot(self):
+        """
+        Regenerate the post code snapshot so that lookups made with it never lag behind the post_codes table.
+        """
+        from src.post_code_snapshot import PostCodeSnapshot
+        post_code_count = PostCodeSnapshot.build(self.env)
+        self.env.msg.info(f'Saved {post_code_count:,} post codes in {PostCodeSnapshot.filepath(self.env)}')
+
+    def prepare_checkpoints(self):
+        """
+        As each area of an --all build is committed, it is recorded in the checkpoint table, keyed by edition,
+        together with the table it was loaded into (post_codes or, with --shadow, post_codes_new).
+        A fresh build discards the edition's existing checkpoints;
+        a resumed build loads them so that the areas already completed can be skipped.
+        The checkpoints are discarded once the build has completed.
+        :raises CodePointOpenError: if the build being resumed loaded a different table (its --shadow option differed)
+        """
+        c = self.env.dbc.cursor()
+        q = f"create table if not exists {self.CHECKPOINT_TABLE} ("
+        q += "edition char(7) not null, "
+        q += "post_code_area varchar(2) not null, "
+        q += "table_name varchar(64) not null, "
+        q += "record_count int unsigned not null, "
+        q += "completed_at timestamp not null default current_timestamp, "
+        q += "primary key (edition, post_code_area))"
+        c.execute(q)
+        if self.env.args.resume:
+            q = f"select post_code_area, table_name, record_count from {self.CHECKPOINT_TABLE} where edition = %s"
+            c.execute(q, (self.edition, ))
+            checkpoints = c.fetchall()
+            other_tables = set(table_name for (_, table_name, _) in checkpoints) - {self.table_name}
+            if len(other_tables) > 0:
+                c.close()
+                e = CodePointOpenError(
+                    f'The build of edition {self.edition} being resumed did not load `{self.table_name}`'
+                )
+                e.add_message(
+                    f"--It loaded `{'`, `'.join(sorted(other_tables))}`: resume it with the same --shadow option"
+                )
+                raise e
+            self.completed_areas = {area: record_count for (area, _, record_count) in checkpoints}
+            if len(self.completed_areas) == 0:
+                self.env.msg.warning(f'No checkpoints found for edition {self.edition}: starting a fresh build')
+        else:
+            c.execute(f"delete from {self.CHECKPOINT_TABLE} where edition = %s", (self.edition, ))
+        self.env.dbc.commit()
+        c.close()
+
+    def record_checkpoint(self, cursor: MySQLCursor, post_code_area: str, record_count: int):
+        """
+        Record that an area has been completed.
+        This is done within the transaction that loads the area so the checkpoint is committed along with its data.
+        """
+        q = f"replace into {self.CHECKPOINT_TABLE} (edition, post_code_area, table_name, record_count) "
+        q += "values (%s, %s, %s, %s)"
+        cursor.execute(q, (self.edition, post_code_area, self.table_name, record_count))
+
+    def clear_checkpoints(self):
+        """
+        Discard the checkpoints of a completed build so that a later --resume cannot mistake it for an interrupted one.
+        """
+        c = self.env.dbc.cursor()
+        c.execute(f"delete from {self.CHECKPOINT_TABLE} where edition = %s", (self.edition, ))
+        self.env.dbc.commit()
+        c.close()
+
+    def tally_completed_areas(self):
+        """
+        Report the areas already completed by the interrupted build being resumed and add them to the running totals.
+        """
+        self.env.msg.info(f'Resuming the build of edition {self.edition}: {len(self.completed_areas)} areas completed')
+        for post_code_area, record_count in sorted(self.completed_areas.items()):
+            self.area_count += 1
+            self.total_record_count += record_count
+            self.env.msg.ok(f'Already loaded {record_count:,} records in Post Code Area "{post_code_area}"')
+
+    def create_shadow_table(self):
+        """
+        Create an empty post_codes_new table with the same structure as post_codes
+        but without its secondary indexes, which are added after the data have been loaded.
+        CREATE TABLE ... LIKE does not copy foreign keys so they too are added after the load.
+        """
+        self.secondary_indexes = self.fetched_secondary_indexes()
+        self.foreign_keys = self.fetched_foreign_keys()
+        c = self.env.dbc.cursor()
+        c.execute(f"drop table if exists {self.SHADOW_TABLE}")
+        c.execute(f"create table {self.SHADOW_TABLE} like post_codes")
+        if len(self.secondary_indexes) > 0:
+            q = f"alter table {self.SHADOW_TABLE} "
+            q += ', '.join(f'drop index `{name}`' for name in self.secondary_indexes.keys())
+            c.execute(q)
+        c.close()
+        self.env.msg.info(f'Building post codes in shadow table `{self.SHADOW_TABLE}`')
+
+    def swap_shadow_table(self):
+        """
+        Add the secondary indexes to the fully loaded post_codes_new table and swap it in for post_codes.
+        The swap is a single, atomic rename: readers see either the old table or the new one, never a partial one.
+        The old table is kept as post_codes_old as a fallback.
+        """
+        if self.area_count == 0:
+            e = CodePointOpenError('No post code areas were processed so the post_codes table has not been replaced.')
+            e.add_message(f'--The partial build has been left in `{self.SHADOW_TABLE}`')
+            raise e
+        c = self.env.dbc.cursor()
+        definitions = [self.index_definition(name, index) for name, index in self.secondary_indexes.items()]
+        definitions += [self.foreign_key_definition(name, key) for name, key in self.foreign_keys.items()]
+        if len(definitions) > 0:
+            self.env.msg.info(f'Adding secondary indexes and foreign keys to `{self.SHADOW_TABLE}`')
+            c.execute(f"alter table {self.SHADOW_TABLE} {', '.join(definitions)}")
+        c.execute(f"drop table if exists {self.FALLBACK_TABLE}")
+        c.execute(f"rename table post_codes to {self.FALLBACK_TABLE}, {self.SHADOW_TABLE} to post_codes")
+        c.close()
+        self.env.msg.info([
+            f'Swapped `{self.SHADOW_TABLE}` in as `post_codes`',
+            f'--The previous table has been kept as `{self.FALLBACK_TABLE}`'
+        ])
+
+    def fetched_secondary_indexes(self) -> dict:
+        """
+        Fetch the definitions of the secondary indexes on the post_codes table from the information schema.
+        :return: A dictionary, keyed by index name, of the index type, its uniqueness and its column list
+        """
+        indexes = {}
+        q = "select index_name, non_unique, index_type, column_name, sub_part from information_schema.statistics "
+        q += "where table_schema = %s and table_name = 'post_codes' and index_name <> 'PRIMARY' "
+        q += "order by index_name, seq_in_index"
+        c = self.env.dbc.cursor()
+        c.execute(q, (self.env.database_name, ))
+        for (index_name, non_unique, index_type, column_name, sub_part) in c:
+            index = indexes.setdefault(index_name, {'unique': not non_unique, 'type': index_type, 'columns': []})
+            if sub_part is None:
+                index['columns'].append(f'`{column_name}`')
+            else:
+                index['columns'].append(f'`{column_name}`({sub_part})')
+        c.close()
+        return indexes
+
+    def fetched_foreign_keys(self) -> dict:
+        """
+        Fetch the definitions of the foreign keys on the post_codes table from the information schema.
+        :return: A dictionary, keyed by constraint name, of the key's columns, the referenced table and columns
+        and its update and delete rules
+        """
+        foreign_keys = {}
+        q = "select r.constraint_name, k.column_name, k.referenced_table_name, k.referenced_column_name, "
+        q += "r.update_rule, r.delete_rule "
+        q += "from information_schema.referential_constraints r "
+        q += "join information_schema.key_column_usage k on k.constraint_schema = r.constraint_schema "
+        q += "and k.constraint_name = r.constraint_name and k.table_name = r.table_name "
+        q += "where r.constraint_schema = %s and r.table_name = 'post_codes' "
+        q += "order by r.constraint_name, k.ordinal_position"
+        c = self.env.dbc.cursor()
+        c.execute(q, (self.env.database_name, ))
+        for (constraint_name, column_name, referenced_table, referenced_column, update_rule, delete_rule) in c:
+            key = foreign_keys.setdefault(constraint_name, {
+                'columns': [],
+                'referenced_table': referenced_table,
+                'referenced_columns': [],
+                'update_rule': update_rule,
+                'delete_rule': delete_rule
+            })
+            key['columns'].append(f'`{column_name}`')
+            key['referenced_columns'].append(f'`{referenced_column}`')
+        c.close()
+        return foreign_keys
+
+    def foreign_key_definition(self, name: str, key: dict) -> str:
+        """
+        :param name:
+        :param key: as returned by fetched_foreign_keys()
+        :return: The alter table clause which re-creates the foreign key on the shadow table
+        """
+        # Constraint names are unique in a database and the original remains on the table being replaced.
+        # A generated name (post_codes_ibfk_<n>) is given as post_codes_new_ibfk_<n>, which the swap's
+        # rename turns back into post_codes_ibfk_<n>; any other name is left for the server to generate.
+        match = re.fullmatch(r'post_codes_ibfk_(\d+)', name)
+        constraint = f'constraint `{self.SHADOW_TABLE}_ibfk_{match.group(1)}` ' if match else ''
+        return (
+            f"add {constraint}foreign key ({', '.join(key['columns'])}) "
+            f"references `{key['referenced_table']}` ({', '.join(key['referenced_columns'])}) "
+            f"on update {key['update_rule'].lower()} on delete {key['delete_rule'].lower()}"
+        )
+
+    @staticmethod
+    def index_definition(name: str, index: dict) -> str:
+        """
+        :param name:
+        :param index: as returned by fetched_secondary_indexes()
+        :return: The alter table clause which re-creates the index
+        """
+        if index['type'] in ['FULLTEXT', 'SPATIAL']:
+            kind = f"{index['type'].lower()} index"
+        elif index['unique']:
+            kind = 'unique index'
+        else:
+            kind = 'index'
+        return f"add {kind} `{name}` ({', '.join(index['columns'])})"
+
+    def processed_area(self, filename: str) -> tuple:
+        """
+        Process the post code area file with the given name.
+        :param filename:
+        :return: A tuple containing the post code area, the filename and
+        either a tuple of the area's record count, reject counts and change counts or None if the file was not found
+        """
+        post_code_area = filename.split('.')[0].upper()
+        try:
+            if self.previous_edition is None:
+                counts = self.process_csv_file(post_code_area, filename)
+            else:
+                counts = self.process_area_deltas(post_code_area, filename)
+        except FileNotFoundError:
+            counts = None
+        return post_code_area, filename, counts
+
+    def parallel_area_results(self) -> Iterator[tuple]:
+        """
+        Spread the post code area files across a pool of --jobs worker processes.
+        Each worker has its own database connection and its own copy of the gss_codes lookup dictionary.
+        :return: The processed_area() results in the order in which the workers complete them
+        """
+        self.env.msg.debug(f'Processing post code areas with {self.jobs} workers')
+        pool = multiprocessing.Pool(
+            self.jobs,
+            initializer=_initialize_worker,
+            initargs=(self.env.worker_parameters(), )
+        )
+        try:
+            yield from pool.imap_unordered(_processed_area, self.data_files())
+            # Let the workers exit normally, closing their database connections, rather than terminating them
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    def tally_area(
+            self,
+            post_code_area: str,
+            filename: str,
+            counts: Union[Tuple[int, collections.Counter, Union[collections.Counter, None]], None]
+    ):
+        """
+        Report the outcome of processing a post code area and add its records to the running totals.
+        :param post_code_area:
+        :param filename:
+        :param counts: A tuple containing the area's record count, its reject counts, keyed by reason,
+        and, when changes between editions have been applied, the counts of new, changed and deleted post codes,
+        or None if the file was not found
+        """
+        if counts is None:
+            w = [
+                f'Skipping Post Code Area "{post_code_area}":',
+                f'>>File {filename} not found'
+            ]
+            self.env.msg.warning(w)
+            return
+        area_record_count, area_rejects, area_changes = counts
+        self.area_count += 1
+        self.total_record_count += area_record_count
+        self.total_rejects.update(area_rejects)
+        if area_changes is None:
+            self.env.msg.ok(f'Processed {area_record_count:,} records in Post Code Area "{post_code_area}"')
+        else:
+            self.total_changes.update(area_changes)
+            self.env.msg.ok(
+                f'Applied changes to Post Code Area "{post_code_area}": {area_changes["new"]:,} new, '
+                f'{area_changes["changed"]:,} changed, {area_changes["deleted"]:,} deleted'
+            )
+        if len(area_rejects) > 0:
+            area_reject_count = sum(area_rejects.values())
+            w = [f'Records skipped in Post Code area {post_code_area} because of errors: {area_reject_count:,}']
+            w += [f'--{reason}: {count:,}' for reason, count in sorted(area_rejects.items())]
+            self.env.msg.warning(w)
+
+    def verified_edition(self, edition: str) -> Tuple[str, Union[CodePointOpenDirectory, CodePointOpenArchive]]:
         """
         Four editions are published per year, nominally in February, May, August and November.
         We denote the edition date in YYYY-MM format.
         Verification fails if
         the edition argument supplied to the application is not in the correct format or
-        the specified dataset does not exist in the external data directory.
-        :return: A tuple containing the verified edition string and the filepath of the edition's raw dataset
+        the specified dataset does not exist in the external data directory,
+        either unpacked into a directory or as the zip archive in which it was distributed.
+        An unpacked directory is preferred if both exist.
+        :param edition: the edition (or, with --update-from, the previous edition) given on the command line
+        :return: A tuple containing the verified edition string and the edition's raw dataset
         """
-        if not re.fullmatch(self.EDITION_PATTERN, self.env.args.edition):
-            raise CodePointOpenError(f"Bad edition specification '{self.env.args.edition}'")
-        data_root = os.path.join(
+        if not re.fullmatch(self.EDITION_PATTERN, edition):
+            raise CodePointOpenError(f"Bad edition specification '{edition}'")
+        edition_root = os.path.join(
             self.env.external_data_root,
             'gazetteer',
-            'os-code-point-open-' + self.env.args.edition,
-            'Data/CSV'
+            'os-code-point-open-' + edition
         )
+        data_root = os.path.join(edition_root, 'Data/CSV')
+        archive_path = edition_root + '.zip'
         if os.path.isdir(data_root):
-            return self.env.args.edition, data_root
+            return edition, CodePointOpenDirectory(data_root)
+        elif os.path.isfile(archive_path):
+            try:
+                return edition, CodePointOpenArchive(archive_path)
+            except zipfile.BadZipFile:
+                e = CodePointOpenError(f'Code Point Open archive for {edition} is not a valid zip file:')
+                e.add_message(f'--{archive_path}')
+                raise e
         else:
-            e = CodePointOpenError(f'Code Point Open data directory for {self.env.args.edition} not found:')
+            e = CodePointOpenError(f'Code Point Open data for {edition} not found:')
             e.add_message(f'--{data_root}')
+            e.add_message(f'--{archive_path}')
             raise e
 
     def data_files(self):
         """
         The full dataset is held in multiple csv text files, one for each post code area.
-        This method yields the name of each of the required files either by scanning the directory in which the files
-        are held (the --all option) or from a list of post code areas specified by the user (the --areas option).
+        This method yields the name of each of the required files either by scanning the directory or archive in which
+        the files are held (the --all option) or
+        from a list of post code areas specified by the user (the --areas option).
         Duplicate areas in a user-specified list are silently ignored.
+        With the --update-from option, the files of both editions are scanned
+        so that areas which appear in only one of them are included.
         :return:
         """
         if self.env.args.all:
-            for entry in os.scandir(self.data_root):
-                yield entry.name
+            for entry in self.source.filenames():
+                if entry.split('.')[0].upper() not in self.completed_areas:
+                    yield entry
+        elif self.previous_edition is not None:
+            filenames = set(self.source.filenames())
+            filenames.update(self.previous_source.filenames())
+            for entry in sorted(filenames):
+                yield entry
         else:
             for entry in set(a.lower() for a in self.env.args.areas):
                 yield f'{entry}.csv'
@@ -117,67 +559,252 @@ class CodePointOpen(object):
     def process_csv_file(self, post_code_area: str, filename: str):
         """
         Process an individual post code area file from the raw dataset.
+        Converted records are collected into batches of --batch-size records
+        which are then sent to the database as multi-row inserts.
+        Rejected records are written to the area's reject file.
         :param post_code_area:
         :param filename:
-        :return:
+        :return: A tuple containing the number of records inserted, the number of rejects, keyed by reason, and None
         """
-        with open(os.path.join(self.data_root, filename), newline='') as f:
+        with self.source.open(filename) as f:
             self.env.msg.info(f'Processing Post Code Area "{post_code_area}"')
             record_count = 0
-            error_count = 0
+            sink = RejectSink(self.rejects_root, post_code_area)
             cursor = self.env.dbc.cursor()
-            if not self.env.args.all:
+            if self.env.args.resume or not self.env.args.all:
                 # Delete existing entries in the post_codes table for the post_code_area
-                q = "delete from post_codes "
-                q += "where post_code regexp %s"
-                post_code_area_regexp = f'^{post_code_area}[0-9]'
-                cursor.execute(q, (post_code_area_regexp, ))
+                # (when resuming, these are whatever the interrupted build left of the area it was loading)
+                cursor.execute(*self.area_deletion(post_code_area))
                 self.env.dbc.commit()
+            batch = []
             for row in csv.reader(f, delimiter=','):
                 try:
-                    self.process_post_code(cursor, row)
-                except CodePointOpenError as e:
-                    self.env.msg.warning(e.messages())
-                    error_count += 1
-                else:
-                    record_count += 1
+                    batch.append(self.post_code_values(row))
+                except CodePointOpenError:
+                    self.reject_rows(sink, [row])
+                if len(batch) >= self.batch_size:
+                    record_count += self.insert_batch(cursor, batch, self.insert_statement, sink)
+                    batch = []
+            if len(batch) > 0:
+                record_count += self.insert_batch(cursor, batch, self.insert_statement, sink)
+            if self.env.args.all:
+                self.record_checkpoint(cursor, post_code_area, record_count)
             cursor.close()
+            sink.close()
             self.env.dbc.commit()
-            return record_count, error_count
+            return record_count, sink.reasons, None
+
+    def area_deletion(self, post_code_area: str) -> Tuple[str, tuple]:
+        """
+        The query (and its parameters) to delete all the existing entries for a post code area.
+        The area is the letters at the start of a post code, so area "B" must match "B1 1AA" but not "BA1 1AA".
+        Rather than a regular expression, which forces a scan of the whole table,
+        the area is matched with the ten prefixes "B0" to "B9": each prefix is a range on the primary key.
+        :param post_code_area:
+        :return: A tuple containing the query and its parameters
+        """
+        q = f"delete from {self.table_name} where "
+        q += " or ".join(["post_code like %s"] * 10)
+        return q, tuple(f'{post_code_area}{digit}%' for digit in range(10))
+
+    def process_area_deltas(
+            self,
+            post_code_area: str,
+            filename: str
+    ) -> Tuple[int, collections.Counter, collections.Counter]:
+        """
+        Apply the changes to an individual post code area between the previous edition and the new one.
+        Area files are in post code order, so the records of the two editions are merged as they are read:
+        post codes only in the new edition are inserted,
+        post codes only in the previous edition are deleted and
+        post codes whose data differ between the editions are updated.
+        The changes are sent to the database in batches of --batch-size as the merge goes along.
+        All other rows in the post_codes table are left untouched.
+        The changes for the area are committed as a single transaction so the table remains online throughout.
+        :param post_code_area:
+        :param filename:
+        :return: A tuple containing the number of records written, the number of rejects, keyed by reason,
+        and the numbers of new, changed and deleted post codes
+        """
+        previous_file = self.opened_area_file(self.previous_source, filename)
+        current_file = self.opened_area_file(self.source, filename)
+        if previous_file is None and current_file is None:
+            raise FileNotFoundError(filename)
+        self.env.msg.info(f'Applying changes to Post Code Area "{post_code_area}"')
+
+        changes = collections.Counter({'new': 0, 'changed': 0, 'deleted': 0})
+        pending = {'new': [], 'changed': [], 'deleted': []}
+        sink = RejectSink(self.rejects_root, post_code_area)
+        cursor = self.env.dbc.cursor()
+        try:
+            previous_rows = self.area_rows(previous_file, filename)
+            current_rows = self.area_rows(current_file, filename)
+            previous = next(previous_rows, None)
+            current = next(current_rows, None)
+            while previous is not None or current is not None:
+                if current is None or (previous is not None and previous[0] < current[0]):
+                    pending['deleted'].append(previous)
+                    previous = next(previous_rows, None)
+                elif previous is None or current[0] < previous[0]:
+                    pending['new'].append(current)
+                    current = next(current_rows, None)
+                else:
+                    if self.compared_fields(previous) != self.compared_fields(current):
+                        pending['changed'].append(current)
+                    previous = next(previous_rows, None)
+                    current = next(current_rows, None)
+                if max(len(rows) for rows in pending.values()) >= self.batch_size:
+                    self.apply_deltas(cursor, pending, changes, sink)
+            self.apply_deltas(cursor, pending, changes, sink)
+        finally:
+            for f in (previous_file, current_file):
+                if f is not None:
+                    f.close()
+            cursor.close()
+            sink.close()
+        self.env.dbc.commit()
+        return changes['new'] + changes['changed'], sink.reasons, changes
+
+    def apply_deltas(self, cursor: MySQLCursor, pending: dict, changes: collections.Counter, sink: RejectSink):
+        """
+        Send the pending new, changed and deleted post codes of an area to the database and clear them.
+        :param cursor:
+        :param pending: lists of raw records keyed by 'new', 'changed' and 'deleted'
+        :param changes: the running counts of the changes made, keyed in the same way
+        :param sink: where to record the rejected records
+        """
+        deleted = [self.formatted_post_code(row[0]) for row in pending['deleted']]
+        changes['deleted'] += len(deleted)
+        upserts = {}
+        for kind in ('new', 'changed'):
+            upserts[kind] = []
+            rejected_rows = []
+            for row in pending[kind]:
+                try:
+                    upserts[kind].append(self.post_code_values(row))
+                except CodePointOpenError:
+                    rejected_rows.append(row)
+            self.reject_rows(sink, rejected_rows)
+            if kind == 'changed':
+                # A post code whose new data are unusable should not keep its stale data either
+                deleted += [self.formatted_post_code(row[0]) for row in rejected_rows]
+        # executemany() would send a delete per post code, so they are deleted --batch-size at a time instead
+        for i in range(0, len(deleted), self.batch_size):
+            post_codes = deleted[i:i + self.batch_size]
+            cursor.execute(self.DELETE_STATEMENT.format(', '.join(['%s'] * len(post_codes))), post_codes)
+        for kind in ('new', 'changed'):
+            if len(upserts[kind]) > 0:
+                changes[kind] += self.insert_batch(cursor, upserts[kind], self.UPSERT_STATEMENT, sink)
+            pending[kind].clear()
+        pending['deleted'].clear()
 
-    def process_post_code(self, cursor: MySQLCursor, data: list):
+    @staticmethod
+    def opened_area_file(source: Union[CodePointOpenDirectory, CodePointOpenArchive], filename: str):
+        """
+        :return: The open area file or None if the area file does not exist in this edition
+        """
+        try:
+            return source.open(filename)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def area_rows(f, filename: str) -> Iterator[list]:
+        """
+        Read the rows of an area file, checking that they are in order of their raw post code.
+        The raw post code is the merge key, rather than the formatted one,
+        because it is the same fixed-width representation in every edition.
+        :param f: the open area file or None if the area file does not exist in this edition
+        :param filename:
+        :raises CodePointOpenError: if the rows are not in post code order
+        """
+        if f is None:
+            return
+        last_post_code = None
+        for row in csv.reader(f, delimiter=','):
+            if last_post_code is not None and row[0] <= last_post_code:
+                raise CodePointOpenError(f'{filename} is not in post code order at "{row[0]}"')
+            last_post_code = row[0]
+            yield row
+
+    @staticmethod
+    def compared_fields(data: list) -> tuple:
         """
-        Process and individual post code record from the raw dataset.
+        The fields of a raw record which contribute to a post_codes row.
+        Changes in the other fields of the raw data have no effect on the post_codes table.
+        :param data:
+        :return:
+        """
+        return data[1], data[2], data[3], data[8]
+
+    def insert_batch(self, cursor: MySQLCursor, batch: list, statement: str, sink: RejectSink) -> int:
+        """
+        Insert a batch of converted post code records with a single multi-row insert.
+        If the database rejects the batch because of the data in it (InnoDB rolls back just that statement)
+        the records are re-inserted one at a time so that only the offending records are rejected.
+        Any other error, such as a deadlock or a lost connection, ends the transaction and so is raised.
         :param cursor:
+        :param batch: a list of value tuples as returned by post_code_values()
+        :param statement: the insert statement to use
+        :param sink: where to record the rejected records
+        :return: The number of records inserted
+        """
+        try:
+            cursor.executemany(statement, batch)
+        except (IntegrityError, DataError):
+            record_count = 0
+            for values in batch:
+                try:
+                    cursor.execute(statement, values)
+                except (IntegrityError, DataError) as e:
+                    (post_code, osx, osy, gr_source_id, district_id) = values
+                    sink.add(sink.DATABASE_ERROR, post_code, osx, osy, gr_source_id, '', f'{e.msg} [{district_id}]')
+                else:
+                    record_count += 1
+            return record_count
+        else:
+            return len(batch)
+
+    def post_code_values(self, data: list) -> tuple:
+        """
+        Convert an individual post code record from the raw dataset into the values for the post_codes table.
         :param data: a list of values extracted from a row in the raw csv data.
         :raises CodePointOpenError: if the gss_admin_area_code given is unknown
         (a gss_admin_area_code left blank, in certain circumstances, can be valid)
-        :raises CodePointOpenError: if there is a database error when posting the record to the post_codes table
+        or if it is that of a split administrative area but the record lies outside all of the area's districts
+        :return: A tuple of values ready to be inserted into the post_codes table
         """
         post_code = self.formatted_post_code(data[0])
         gr_source_id = int(data[1]) + 400
         osx = data[2]
         osy = data[3]
-        try:
-            if data[8] == 'E06000004':  # Stockton-on-Tees
-                district_id = self.STOCKTON_DIVISIONS[post_code[:-4]]
-            else:
-                district_id = self.gss_codes[data[8]]
-        except KeyError:
-            if data[8] == '' and gr_source_id in [460, 490]:
-                district_id = None
-            else:
-                raise CodePointOpenError(
-                    f'Problem with district code {data[8]} at {post_code} [{osx},{osy}] {gr_source_id}')
+        if self.boundaries.is_split(data[8]):
+            district_id = self.boundaries.district_id(data[8], float(osx), float(osy))
+        elif data[8] in self.OUTWARD_CODE_DIVISIONS:
+            district_id = self.OUTWARD_CODE_DIVISIONS[data[8]].get(post_code[:-4])
+        else:
+            district_id = self.gss_codes.get(data[8])
+        if district_id is None and not (data[8] == '' and gr_source_id in [460, 490]):
+            raise CodePointOpenError(
+                f'Problem with district code {data[8]} at {post_code} [{osx},{osy}] {gr_source_id}'
+            )
+        return post_code, osx, osy, gr_source_id, district_id
 
-        try:
-            q = f'insert into post_codes values (%s, %s, %s, %s, %s)'
-            cursor.execute(q, (post_code, osx, osy, gr_source_id, district_id))
-        except MySQLError as mse:
-            e = CodePointOpenError(f'Error attempting to insert {post_code} into `post_codes` table')
-            e.add_message(mse.args[1])
-            e.add_message(f'[{osx}, {osy}] {gr_source_id} {district_id}')
-            raise e
+    def reject_rows(self, sink: RejectSink, rows: Iterable[list]):
+        """
+        Record the raw post code records which post_code_values() rejected.
+        :param sink:
+        :param rows:
+        """
+        for data in rows:
+            sink.add(
+                sink.OUTSIDE_SPLIT_DISTRICTS if self.boundaries.is_split(data[8]) else sink.UNKNOWN_DISTRICT,
+                self.formatted_post_code(data[0]),
+                data[2],
+                data[3],
+                int(data[1]) + 400,
+                data[8]
+            )
 
     def final_overview(self):
         """
@@ -186,9 +813,15 @@ class CodePointOpen(object):
         m = [
             'Processing Complete',
             f'--Post Code Areas processed: {self.area_count}',
-            f'--Total Post Codes processed: {self.total_record_count:,}',
-            '--'
+            f'--Total Post Codes processed: {self.total_record_count:,}'
         ]
+        if self.previous_edition is not None:
+            m += [f'>>{kind.capitalize()}: {self.total_changes[kind]:,}' for kind in ('new', 'changed', 'deleted')]
+        if len(self.total_rejects) > 0:
+            m.append(f'--Total Post Codes rejected: {sum(self.total_rejects.values()):,}')
+            m += [f'>>{reason}: {count:,}' for reason, count in sorted(self.total_rejects.items())]
+            m.append(f'--Rejected records have been written to {self.rejects_root}')
+        m.append('--')
         if not self.env.args.quiet:
             print()
         self.env.msg.ok(m)
@@ -206,6 +839,27 @@ class CodePointOpen(object):
         c.close()
         return gss_codes
 
+    def loaded_district_boundaries(self) -> DistrictBoundaries:
+        """
+        Load the boundaries of the districts into which split administrative areas are divided
+        from gazetteer/split-districts.json in the external data directory (see DistrictBoundaries for its format).
+        A split administrative area which the file does not cover (or every one, if there is no file)
+        falls back to having its post codes divided by outward code, as listed in OUTWARD_CODE_DIVISIONS.
+        """
+        filepath = os.path.join(self.env.external_data_root, 'gazetteer', self.SPLIT_DISTRICTS_FILENAME)
+        if not os.path.isfile(filepath):
+            self.env.msg.info([
+                f'No split district boundaries found at {filepath}',
+                '--Post codes in split administrative areas are assigned to districts by outward code'
+            ])
+            return DistrictBoundaries()
+        try:
+            return DistrictBoundaries(filepath)
+        except (ValueError, KeyError) as e:
+            error = CodePointOpenError(f'Bad split district boundaries file {filepath}')
+            error.add_message(f'--{e}')
+            raise error
+
     @staticmethod
     def formatted_post_code(raw_post_code: str) -> str:
         """
@@ -218,3 +872,18 @@ class CodePointOpen(object):
         :return: The single-space formatted post code.
         """
         return f'{raw_post_code[:-3].strip()} {raw_post_code[-3:]}'
+
+
+# Each worker process in a parallel build holds its own CodePointOpen object (and hence its own database connection)
+_worker = None
+
+
+def _initialize_worker(parameters: dict):
+    global _worker
+    _worker = CodePointOpen(WorkerEnvironment(parameters))
+    # Pool workers leave with os._exit(), which skips atexit handlers, but multiprocessing's own finalizers do run
+    multiprocessing.util.Finalize(None, _worker.env.clean_up, exitpriority=10)
+
+
+def _processed_area(filename: str) -> tuple:
+    return _worker.processed_area(filename)
@@ -0,0 +1,162 @@
+from typing import Iterable, List
+
+import array
+import json
+import os
+import struct
+import sys
+
+
+class ColumnFile(object):
+    """
+    A table's rows held column by column in typed binary batches, so that a table can be exported and imported
+    without formatting its values as text and parsing them again.
+
+    The file comprises a signature, the length of a json header and the header itself, which names each column
+    and gives its type, and then the batches.
+    Each batch is its row count followed by one block per column, each block being its length, a null mask
+    (a byte per row) and the column's values:
+    'int' columns as 8-byte signed integers, 'float' columns as doubles, 'uuid' columns as 16 bytes per row and
+    'bytes' and 'text' columns as 4-byte lengths followed by the values (text encoded as utf-8).
+    Numbers are little-endian. A null takes a zero (or empty) value which the null mask overrides.
+    """
+    SIGNATURE = b'NPADBCOL'
+    TYPES = ('int', 'float', 'uuid', 'bytes', 'text')
+    UUID_WIDTH = 16
+
+    @classmethod
+    def encoded_column(cls, column_type: str, values: list) -> bytes:
+        mask = bytes(1 if value is None else 0 for value in values)
+        if column_type == 'int':
+            data = cls.little_endian(array.array('q', (0 if value is None else value for value in values)))
+        elif column_type == 'float':
+            data = cls.little_endian(array.array('d', (0.0 if value is None else value for value in values)))
+        elif column_type == 'uuid':
+            data = b''.join(bytes(cls.UUID_WIDTH) if value is None else bytes(value) for value in values)
+        else:
+            if column_type == 'text':
+                items = [b'' if value is None else value.encode('utf-8') for value in values]
+            else:
+                items = [b'' if value is None else bytes(value) for value in values]
+            data = cls.little_endian(array.array('I', (len(item) for item in items))).tobytes() + b''.join(items)
+        return mask + bytes(data)
+
+    @classmethod
+    def decoded_column(cls, column_type: str, block: memoryview, row_count: int) -> list:
+        mask = block[:row_count]
+        data = block[row_count:]
+        if column_type in ('int', 'float'):
+            a = array.array('q' if column_type == 'int' else 'd')
+            a.frombytes(data)
+            values = cls.little_endian(a).tolist()
+        elif column_type == 'uuid':
+            values = [bytes(data[i * cls.UUID_WIDTH:(i + 1) * cls.UUID_WIDTH]) for i in range(row_count)]
+        else:
+            lengths = array.array('I')
+            lengths.frombytes(data[:4 * row_count])
+            lengths = cls.little_endian(lengths)
+            values = []
+            offset = 4 * row_count
+            for length in lengths:
+                item = bytes(data[offset:offset + length])
+                values.append(item.decode('utf-8') if column_type == 'text' else item)
+                offset += length
+        return [None if is_null else value for (is_null, value) in zip(mask, values)]
+
+    @staticmethod
+    def little_endian(a: array.array) -> array.array:
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a
+
+
+class ColumnFileWriter(ColumnFile):
+    """
+    Write a column file batch by batch.
+    The file is written under a temporary name and only moved into place when it is closed.
+    """
+
+    def __init__(self, filepath: str, columns: list):
+        """
+        :param filepath:
+        :param columns: A list of (column name, column type) tuples
+        :raises ValueError: if a column type is not one of ColumnFile.TYPES
+        """
+        for (name, column_type) in columns:
+            if column_type not in self.TYPES:
+                raise ValueError(f"Column '{name}' has unknown type '{column_type}'")
+        self.filepath = filepath
+        self.column_types = [column_type for (_, column_type) in columns]
+        self.temporary_filepath = f'{filepath}.tmp'
+        self.file = open(self.temporary_filepath, 'wb')
+        header = json.dumps({'columns': [{'name': name, 'type': column_type} for (name, column_type) in columns]})
+        header_bytes = header.encode('utf-8')
+        self.file.write(self.SIGNATURE)
+        self.file.write(struct.pack('<I', len(header_bytes)))
+        self.file.write(header_bytes)
+
+    def write_batch(self, rows: list):
+        """
+        :param rows: A list of rows, each a sequence of values in column order
+        """
+        self.file.write(struct.pack('<I', len(rows)))
+        for (i, column_type) in enumerate(self.column_types):
+            block = self.encoded_column(column_type, [row[i] for row in rows])
+            self.file.write(struct.pack('<Q', len(block)))
+            self.file.write(block)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temporary_filepath, self.filepath)
+
+    def abandon(self):
+        """
+        Close and remove the partly written file, leaving any existing file in place.
+        """
+        self.file.close()
+        os.remove(self.temporary_filepath)
+
+
+class ColumnFileReader(ColumnFile):
+    """
+    Read a column file a batch at a time.
+    """
+
+    def __init__(self, filepath: str):
+        """
+        :param filepath:
+        :raises FileNotFoundError: if the file does not exist
+        :raises ValueError: if the file is not a column file
+        """
+        self.filepath = filepath
+        self.file = open(filepath, 'rb')
+        if self.file.read(len(self.SIGNATURE)) != self.SIGNATURE:
+            self.file.close()
+            raise ValueError(f'{filepath} is not a column file')
+        (header_length, ) = struct.unpack('<I', self.file.read(4))
+        header = json.loads(self.file.read(header_length).decode('utf-8'))
+        self.column_names = [column['name'] for column in header['columns']]
+        self.column_types = [column['type'] for column in header['columns']]
+
+    def batches(self) -> Iterable[List[list]]:
+        """
+        :return: The batches in turn, each a list of columns of values
+        """
+        while True:
+            count_bytes = self.file.read(4)
+            if len(count_bytes) == 0:
+                return
+            (row_count, ) = struct.unpack('<I', count_bytes)
+            columns = []
+            for column_type in self.column_types:
+                (block_length, ) = struct.unpack('<Q', self.file.read(8))
+                block = memoryview(self.file.read(block_length))
+                columns.append(self.decoded_column(column_type, block, row_count))
+            yield columns
+
+    def rows(self) -> Iterable[tuple]:
+        for columns in self.batches():
+            yield from zip(*columns)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,46 @@
+from src.environment import MyEnvironment, WorkerEnvironment
+
+import contextlib
+import queue
+
+
+class ConnectionPool(object):
+    """
+    A fixed number of worker environments, each with a database connection of its own,
+    shared among the threads of a task which works on several tables at once.
+    A thread borrows an environment for the duration of one piece of work and then hands it back.
+    All the environments share the main environment's schema catalogue.
+    """
+
+    def __init__(self, env: MyEnvironment, size: int, session_statements: list = None):
+        """
+        :param env:
+        :param size: the number of connections in the pool
+        :param session_statements: statements to run on each connection as it is opened,
+        for example to set session variables
+        """
+        self.environments = [WorkerEnvironment(env.worker_parameters()) for _ in range(size)]
+        self.available = queue.Queue()
+        for worker_env in self.environments:
+            worker_env.schema_catalogue = env.schema_catalogue
+            if session_statements:
+                c = worker_env.dbc.cursor()
+                for q in session_statements:
+                    c.execute(q)
+                c.close()
+            self.available.put(worker_env)
+
+    @contextlib.contextmanager
+    def environment(self):
+        """
+        Borrow a worker environment, waiting for one to become available if need be.
+        """
+        worker_env = self.available.get()
+        try:
+            yield worker_env
+        finally:
+            self.available.put(worker_env)
+
+    def close(self):
+        for worker_env in self.environments:
+            worker_env.clean_up()
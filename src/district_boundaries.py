@@ -0,0 +1,105 @@
+from typing import Union
+
+import json
+
+
+class SplitDistrict(object):
+    """
+    An administrative area whose post codes are divided between more than one of our districts.
+    The boundary of each district is given as a list of rings of (easting, northing) vertices.
+    A point is inside a district if it is inside an odd number of its rings,
+    which accommodates districts made up of several polygons and polygons with holes.
+
+    To keep point-in-polygon tests fast enough to run for every post code in the area,
+    the boundary edges are indexed on a grid of square cells:
+    a point is only tested against the edges which cross its cell's horizontal band and
+    a point in a cell which no edge passes through takes the district of the centre of that cell.
+    """
+    CELL_SIZE = 1000
+
+    def __init__(self, districts: list):
+        """
+        :param districts: A list of dicts, each with a district_id and a list of rings
+        """
+        self.district_ids = []
+        self.bands = {}
+        self.edge_cells = set()
+        self.cell_districts = {}
+        for (i, district) in enumerate(districts):
+            self.district_ids.append(district['district_id'])
+            for ring in district['rings']:
+                for (j, (x1, y1)) in enumerate(ring):
+                    (x2, y2) = ring[j - 1]
+                    if y1 != y2:
+                        self.index_edge(i, (x1, y1, x2, y2))
+
+    def index_edge(self, district_index: int, edge: tuple):
+        (x1, y1, x2, y2) = edge
+        (column_from, column_to) = sorted([self.cell(x1), self.cell(x2)])
+        (band_from, band_to) = sorted([self.cell(y1), self.cell(y2)])
+        for band in range(band_from, band_to + 1):
+            self.bands.setdefault(band, {}).setdefault(district_index, []).append(edge)
+            for column in range(column_from, column_to + 1):
+                self.edge_cells.add((column, band))
+
+    def cell(self, coordinate: float) -> int:
+        return int(coordinate // self.CELL_SIZE)
+
+    def district_id(self, x: float, y: float) -> Union[int, None]:
+        """
+        :return: The district_id of the district containing the point or None if it is not in any of them
+        """
+        cell = (self.cell(x), self.cell(y))
+        if cell in self.edge_cells:
+            return self.located_district_id(x, y)
+        try:
+            return self.cell_districts[cell]
+        except KeyError:
+            centre = [(c + 0.5) * self.CELL_SIZE for c in cell]
+            self.cell_districts[cell] = self.located_district_id(*centre)
+            return self.cell_districts[cell]
+
+    def located_district_id(self, x: float, y: float) -> Union[int, None]:
+        """
+        Cast a ray from the point in the direction of increasing easting and count the boundary edges it crosses.
+        """
+        for (district_index, edges) in self.bands.get(self.cell(y), {}).items():
+            inside = False
+            for (x1, y1, x2, y2) in edges:
+                if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+            if inside:
+                return self.district_ids[district_index]
+        return None
+
+
+class DistrictBoundaries(object):
+    """
+    The boundaries of those administrative areas (identified by their GSS codes) which are split between districts.
+    The boundaries are held in a json file of the form:
+    {"<gss_admin_area_code>": [{"district_id": <int>, "rings": [[[<easting>, <northing>], ...], ...]}, ...], ...}
+    Any GSS code in the file is treated as split: recording a new split needs no change to the code.
+    """
+
+    def __init__(self, filepath: Union[str, None] = None):
+        """
+        :param filepath: The json boundary file or None if no administrative areas are split
+        :raises ValueError: if the file is not valid json
+        :raises KeyError: if a district in the file is missing its district_id or rings
+        """
+        self.filepath = filepath
+        self.split_areas = {}
+        if filepath is not None:
+            with open(filepath, 'r') as f:
+                data = json.load(f)
+            for (gss_code, districts) in data.items():
+                self.split_areas[gss_code] = SplitDistrict(districts)
+
+    def is_split(self, gss_code: str) -> bool:
+        return gss_code in self.split_areas
+
+    def district_id(self, gss_code: str, x: float, y: float) -> Union[int, None]:
+        """
+        :return: The district_id of the district containing the point or None if it is not in any of them
+        """
+        return self.split_areas[gss_code].district_id(x, y)
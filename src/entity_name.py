@@ -1,5 +1,7 @@
 from typing import Union
 
+import functools
+
 
 class EntityName(object):
     """
@@ -59,6 +61,15 @@ class EntityName(object):
         s = self.name_as_given.translate(self.PUNCTUATION)
         return [element.lower() for element in s.split()]
 
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def cached_index_name(name: str, current_index_name: Union[str, None], special_index: int) -> str:
+        """
+        The index name of the given name, remembered so that names which recur
+        (from one import row to the next or from one table to another) are only indexed once.
+        """
+        return EntityName(name, current_index_name).index_name(special_index)
+
     @staticmethod
     def without_leading_article(elements):
         if elements[0] in EntityName.ARTICLES:
@@ -1,11 +1,26 @@
 from npm_common.common_utilities  import MyStatusMessage
 from npm_common.base_environment import BaseEnvironment
+from src.schema_catalogue import SchemaCatalogue
 from configparser import ConfigParser
 
 import mysql.connector
 import argparse
 
 
+def positive_integer(value: str) -> int:
+    """
+    An argparse type for options, such as batch sizes and numbers of jobs, which must be positive integers.
+    :raises argparse.ArgumentTypeError: if the value is not a positive integer
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{number} is not a positive integer')
+    return number
+
+
 class MyArguments(object):
     """
     Class to parse command line arguments.
@@ -68,6 +83,61 @@ class MyArguments(object):
             metavar='<TABLE>'
         )
 
+        db_init_parser.add_argument(
+            '-b', '--batch-size',
+            type=positive_integer,
+            default=1000,
+            help='number of rows sent to the database in each multi-row insert (default: %(default)s)',
+            metavar='N'
+        )
+
+        db_init_parser.add_argument(
+            '-j', '--jobs',
+            type=positive_integer,
+            default=1,
+            help='number of tables to build at the same time (default: %(default)s)',
+            metavar='N'
+        )
+
+        db_init_parser.add_argument(
+            '-l', '--load-data',
+            action='store_true',
+            help='bulk load tables with LOAD DATA LOCAL INFILE where possible'
+        )
+
+        db_init_parser.add_argument(
+            '-d', '--defer-indexes',
+            action='store_true',
+            help='load tables with only their primary keys and add their other indexes afterwards'
+        )
+
+        db_init_parser.add_argument(
+            '-s', '--sort',
+            action='store_true',
+            help='sort the rows of each table into primary key order before loading them'
+        )
+
+        db_init_parser.add_argument(
+            '--diff',
+            action='store_true',
+            help='apply only the differences between the csv files and existing tables instead of rebuilding them '
+                 '(table structures are not changed)'
+        )
+
+        db_init_parser.add_argument(
+            '-f', '--force',
+            action='store_true',
+            help='with --all, rebuild tables even if their files are unchanged since they were last built'
+        )
+
+        db_init_parser.add_argument(
+            '--format',
+            choices=['csv', 'binary'],
+            default='csv',
+            help='import csv files from the table groups or binary column files from the export directory '
+                 '(default: %(default)s)'
+        )
+
         # Add sub-parser for the data export task
         export_parser = subparsers.add_parser(
             'Export',
@@ -86,6 +156,51 @@ class MyArguments(object):
             help='Table(s) to export',
             metavar='table'
         )
+        export_parser.add_argument(
+            '-b', '--batch-size',
+            type=positive_integer,
+            default=1000,
+            help='number of rows fetched from the database at a time (default: %(default)s)',
+            metavar='N'
+        )
+        export_parser.add_argument(
+            '-j', '--jobs',
+            type=positive_integer,
+            default=1,
+            help='number of tables to export at the same time (default: %(default)s)',
+            metavar='N'
+        )
+        export_parser.add_argument(
+            '--chunk-threshold',
+            type=int,
+            default=500000,
+            help='with --jobs, split tables with more rows than this into primary key ranges '
+                 '(default: %(default)s)',
+            metavar='ROWS'
+        )
+        export_parser.add_argument(
+            '--chunks',
+            type=positive_integer,
+            default=4,
+            help='number of primary key ranges into which large tables are split (default: %(default)s)',
+            metavar='N'
+        )
+        export_parser.add_argument(
+            '-c', '--compress',
+            choices=['gzip', 'zstd'],
+            help='compress the exported files'
+        )
+        export_parser.add_argument(
+            '--format',
+            choices=['csv', 'binary'],
+            default='csv',
+            help='export csv files or binary column files which keep the values\' types (default: %(default)s)'
+        )
+        export_parser.add_argument(
+            '-f', '--force',
+            action='store_true',
+            help='export tables even if they are unchanged since they were last exported'
+        )
 
         # Add sub-parser for the table list task
         list_parser = subparsers.add_parser(
@@ -203,6 +318,115 @@ class MyArguments(object):
             help='Specify the post code areas to import',
             metavar='AREA'
         )
+        post_code_sources.add_argument(
+            '--update-from',
+            help='Apply only the changes made since a previous edition',
+            metavar='YYYY-MM'
+        )
+
+        post_code_builder_parser.add_argument(
+            '-s', '--shadow',
+            action='store_true',
+            help='with --all, build into a shadow table and swap it in when complete'
+        )
+
+        post_code_builder_parser.add_argument(
+            '-r', '--resume',
+            action='store_true',
+            help='with --all, resume an interrupted build, skipping the areas it completed'
+        )
+
+        post_code_builder_parser.add_argument(
+            '-b', '--batch-size',
+            type=positive_integer,
+            default=5000,
+            help='number of post codes sent to the database in each multi-row insert (default: %(default)s)',
+            metavar='N'
+        )
+
+        post_code_builder_parser.add_argument(
+            '-j', '--jobs',
+            type=positive_integer,
+            default=1,
+            help='number of post code areas to process in parallel (default: %(default)s)',
+            metavar='N'
+        )
+
+        # Add sub_parser for the 'NearestPostCodes' task
+        nearest_post_codes_parser = subparsers.add_parser(
+            'NearestPostCodes',
+            description='Find the post codes nearest to OS grid coordinates',
+            help='Find the nearest post codes.'
+        )
+
+        nearest_post_codes_parser.add_argument(
+            '-b', '--build',
+            action='store_true',
+            help='(re)build the post code locator index from the post_codes table first'
+        )
+
+        nearest_post_codes_parser.add_argument(
+            '-p', '--point',
+            nargs=2,
+            type=float,
+            action='append',
+            help='a point to look up (may be repeated)',
+            metavar=('EASTING', 'NORTHING')
+        )
+
+        nearest_post_codes_parser.add_argument(
+            '-f', '--file',
+            help='tab-separated file of eastings and northings to look up',
+            metavar='FILE'
+        )
+
+        nearest_post_codes_parser.add_argument(
+            '-k',
+            type=int,
+            default=1,
+            help='number of post codes to find for each point (default: %(default)s)'
+        )
+
+        nearest_post_codes_parser.add_argument(
+            '-r', '--radius',
+            type=float,
+            help='find all the post codes within this many metres instead',
+            metavar='METRES'
+        )
+
+        # Add sub_parser for the 'Geocode' task
+        geocode_parser = subparsers.add_parser(
+            'Geocode',
+            description='Add coordinates and districts to a file of post codes',
+            help='Geocode a file of post codes.'
+        )
+
+        geocode_parser.add_argument(
+            'file',
+            nargs='?',
+            help='tab-separated file containing post codes',
+            metavar='FILE'
+        )
+
+        geocode_parser.add_argument(
+            '-s', '--snapshot',
+            action='store_true',
+            help='(re)build the post code snapshot from the post_codes table first'
+        )
+
+        geocode_parser.add_argument(
+            '-c', '--column',
+            type=int,
+            default=1,
+            help='the column of FILE which holds the post codes (default: %(default)s)',
+            metavar='N'
+        )
+
+        geocode_parser.add_argument(
+            '-o', '--output',
+            help='write the geocoded file here rather than to the console',
+            metavar='FILE'
+        )
 
         # Decide whether to parse 'test arguments' provided internally
         # or real arguments from the command line
@@ -256,15 +480,38 @@ class MyEnvironment(BaseEnvironment):
         self.args = self.argument_parser.arguments
         self.msg = MyStatusMessage(self.args.verbosity)
         self.database_name = 'all_the_stations'
-        self.dbc = mysql.connector.connect(
-            user=self.program.config['database']['username'],
-            host=self.program.config['database']['host'],
-            password=self.program.config['database']['password'],
-            database=self.database_name
-        )
+        self.dbc = mysql.connector.connect(**self.connection_parameters())
+        self.schema_catalogue = SchemaCatalogue(self.database_name)
         self.npadb_data_root = '/home/natasha/CloudStation/npadb/all-the-stations/data'
         self.external_data_root = '/home/natasha/CloudStation/npadb/all-the-stations/external-data'
 
+    def connection_parameters(self) -> dict:
+        """
+        :return: the keyword arguments needed to open a connection to the database
+        :rtype: dict
+        """
+        return {
+            'user': self.program.config['database']['username'],
+            'host': self.program.config['database']['host'],
+            'password': self.program.config['database']['password'],
+            'database': self.database_name,
+            # LOAD DATA LOCAL INFILE is only needed (and only allowed) when Import is asked to bulk load
+            'allow_local_infile': getattr(self.args, 'load_data', False)
+        }
+
+    def worker_parameters(self) -> dict:
+        """
+        The (picklable) subset of the environment needed to set up a WorkerEnvironment in another process.
+        :return:
+        :rtype: dict
+        """
+        return {
+            'args': self.args,
+            'connection': self.connection_parameters(),
+            'npadb_data_root': self.npadb_data_root,
+            'external_data_root': self.external_data_root
+        }
+
     def render_base_program_info(self):
         if self.args.verbosity > 0:
             print(self.program.welcome(self.user.username))
@@ -280,3 +527,32 @@ class MyEnvironment(BaseEnvironment):
 
     def clean_up(self):
         self.dbc.close()
+
+
+class WorkerEnvironment(object):
+    """
+    A cut-down environment for workers running in parallel with the main program.
+    A worker shares the main program's arguments and data roots but has a database connection of its own.
+    """
+
+    def __init__(self, parameters: dict):
+        """
+        :param parameters: as returned by MyEnvironment.worker_parameters()
+        """
+        self.args = parameters['args']
+        self.msg = MyStatusMessage(self.args.verbosity)
+        self.database_name = parameters['connection']['database']
+        self.connection = parameters['connection']
+        self.dbc = mysql.connector.connect(**self.connection)
+        self.schema_catalogue = SchemaCatalogue(self.database_name)
+        self.npadb_data_root = parameters['npadb_data_root']
+        self.external_data_root = parameters['external_data_root']
+
+    def connection_parameters(self) -> dict:
+        """
+        :return: the keyword arguments needed to open another connection to the database
+        """
+        return self.connection
+
+    def clean_up(self):
+        self.dbc.close()
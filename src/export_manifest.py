@@ -0,0 +1,82 @@
+from src.environment import MyEnvironment
+from typing import Union
+
+import json
+import os
+
+
+class ExportManifest(object):
+    """
+    A record, kept in the export directory, of the checksum of each table when it was last exported.
+    A table whose checksum is unchanged need not be exported again as long as its export file is still there.
+
+    The manifest is a json file of the form:
+    {"<table_name>": {"checksum": <int>, "compression": <null|"gzip"|"zstd">, "format": <"csv"|"binary">}, ...}
+    """
+    FILENAME = 'manifest.json'
+
+    def __init__(self, env: MyEnvironment):
+        self.env = env
+        self.filepath = os.path.join(env.npadb_data_root, 'export', self.FILENAME)
+        try:
+            with open(self.filepath, 'r') as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+        except ValueError:
+            env.msg.warning(f'Ignoring unreadable export manifest {self.filepath}')
+            self.data = {}
+
+    def checksums(self, table_names: list) -> dict:
+        """
+        Checksum the tables in a single CHECKSUM TABLE statement.
+        :return: Checksums keyed by table name: None for a table which does not exist
+        """
+        if len(table_names) == 0:
+            return {}
+        q = f"CHECKSUM TABLE {', '.join(f'`{table_name}`' for table_name in table_names)}"
+        c = self.env.dbc.cursor()
+        c.execute(q)
+        # The table is named as database.table in the result
+        checksums = {qualified_name.split('.', 1)[-1]: checksum for (qualified_name, checksum) in c}
+        c.close()
+        return {table_name: checksums.get(table_name) for table_name in table_names}
+
+    def is_unchanged(
+            self,
+            table_name: str,
+            checksum: Union[int, None],
+            export_filepath: str,
+            compression: str,
+            export_format: str = 'csv'
+    ) -> bool:
+        """
+        :return: True if the table's checksum, compression and format are those of its last export
+        and the export file exists
+        """
+        entry = self.data.get(table_name)
+        return (
+            checksum is not None
+            and entry is not None
+            and entry['checksum'] == checksum
+            and entry['compression'] == compression
+            and entry.get('format', 'csv') == export_format
+            and os.path.exists(export_filepath)
+        )
+
+    def record(self, table_name: str, checksum: Union[int, None], compression: str, export_format: str = 'csv'):
+        if checksum is None:
+            self.data.pop(table_name, None)
+        else:
+            self.data[table_name] = {'checksum': checksum, 'compression': compression, 'format': export_format}
+
+    def save(self):
+        """
+        Write the manifest under a temporary name and then move it into place
+        so that an interrupted export cannot leave it half written.
+        """
+        temporary_filepath = f'{self.filepath}.tmp'
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        with open(temporary_filepath, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(temporary_filepath, self.filepath)
@@ -0,0 +1,70 @@
+from src.environment import MyEnvironment, WorkerEnvironment
+from typing import Union
+
+import hashlib
+import json
+
+
+class ImportState(object):
+    """
+    A record, kept in the database, of the content hash of each table's source files when it was last built.
+    The hash covers the table's DDL file, its data file and its metadata, so a table whose hash is unchanged
+    would be rebuilt exactly as it is and need not be rebuilt at all.
+    """
+    STATE_TABLE = 'table_import_state'
+    READ_SIZE = 1 << 20
+
+    def __init__(self, env: MyEnvironment):
+        self.env = env
+        self.hashes = {}
+        c = self.env.dbc.cursor()
+        q = f"create table if not exists {self.STATE_TABLE} ("
+        q += "table_name varchar(64) not null, "
+        q += "content_hash char(64) not null, "
+        q += "imported_at timestamp not null default current_timestamp, "
+        q += "primary key (table_name))"
+        c.execute(q)
+        c.execute(f"select table_name, content_hash from {self.STATE_TABLE}")
+        self.recorded_hashes = {table_name: content_hash for (table_name, content_hash) in c}
+        self.env.dbc.commit()
+        c.close()
+
+    def content_hash(self, table_name: str, table_metadata: dict, ddl_filepath: str, data_filepath: str) -> str:
+        """
+        The sha256 of the table's metadata, DDL file and data file, each preceded by its length.
+        Hashes are remembered for the rest of the run.
+        :raises FileNotFoundError: if the DDL or data file does not exist
+        """
+        if table_name in self.hashes:
+            return self.hashes[table_name]
+        h = hashlib.sha256()
+        metadata = json.dumps(table_metadata, sort_keys=True).encode('utf-8')
+        h.update(len(metadata).to_bytes(8, 'little'))
+        h.update(metadata)
+        for filepath in (ddl_filepath, data_filepath):
+            with open(filepath, 'rb') as f:
+                f.seek(0, 2)
+                h.update(f.tell().to_bytes(8, 'little'))
+                f.seek(0)
+                while True:
+                    chunk = f.read(self.READ_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    h.update(chunk)
+        self.hashes[table_name] = h.hexdigest()
+        return self.hashes[table_name]
+
+    def is_unchanged(self, table_name: str, content_hash: str) -> bool:
+        return self.recorded_hashes.get(table_name) == content_hash
+
+    def record(self, env: Union[MyEnvironment, WorkerEnvironment], table_name: str, content_hash: str):
+        """
+        Record that a table has been built from source files with the given hash.
+        :param env: the environment whose database connection built the table
+        """
+        c = env.dbc.cursor()
+        q = f"replace into {self.STATE_TABLE} (table_name, content_hash) values (%s, %s)"
+        c.execute(q, (table_name, content_hash))
+        env.dbc.commit()
+        c.close()
+        self.recorded_hashes[table_name] = content_hash
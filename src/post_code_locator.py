@@ -0,0 +1,159 @@
+from src.array_file import ArrayFile
+from src.environment import MyEnvironment
+from src.exceptions import NPMException
+from typing import Iterable, List, Tuple
+
+import array
+import bisect
+import heapq
+import math
+import os
+
+
+class PostCodeLocator(object):
+    """
+    A reverse geocoder: which post codes are nearest to a given point?
+
+    The post codes and their OS grid coordinates are copied from the post_codes table into a memory-mapped
+    grid index. Post codes are sorted by the square grid cell they fall in, row by row, so the post codes of any
+    horizontal run of cells are contiguous and can be found with a single binary search of the cell keys.
+    A nearest neighbour search examines rings of cells of increasing size around the query point
+    and stops as soon as no unexamined cell could hold anything nearer than what has been found already.
+    """
+    CELL_SIZE = 1000
+    ROW_WIDTH = 1 << 20
+    POST_CODE_WIDTH = 8
+    FILENAME = 'post-code-locator.dat'
+
+    def __init__(self, filepath: str):
+        """
+        :raises NPMException: if the index has not been built
+        """
+        try:
+            self.index = ArrayFile(filepath)
+        except (FileNotFoundError, ValueError) as e:
+            raise NPMException(f'Post code locator index unavailable: {e}')
+        self.cells = self.index['cells']
+        self.starts = self.index['starts']
+        self.x = self.index['x']
+        self.y = self.index['y']
+        self.post_codes = self.index['post_codes']
+        self.max_ring = self.index.metadata['max_ring']
+
+    @classmethod
+    def filepath(cls, env: MyEnvironment) -> str:
+        return os.path.join(env.external_data_root, 'gazetteer', cls.FILENAME)
+
+    @classmethod
+    def build(cls, env: MyEnvironment) -> int:
+        """
+        (Re)build the index from the post_codes table.
+        Post codes without coordinates are left out.
+        :return: The number of post codes indexed
+        """
+        q = "select post_code, osx, osy from post_codes where osx <> 0 or osy <> 0"
+        c = env.dbc.cursor()
+        c.execute(q)
+        rows = sorted(
+            ((cls.cell_key(cls.cell(x), cls.cell(y)), x, y, post_code) for (post_code, x, y) in c),
+            key=lambda row: row[0]
+        )
+        c.close()
+
+        cells = array.array('q')
+        starts = array.array('q')
+        for (i, row) in enumerate(rows):
+            if len(cells) == 0 or cells[-1] != row[0]:
+                cells.append(row[0])
+                starts.append(i)
+        starts.append(len(rows))
+        post_codes = b''.join(row[3].encode('ascii').ljust(cls.POST_CODE_WIDTH) for row in rows)
+        extent = max([cls.cell(row[1]) for row in rows] + [cls.cell(row[2]) for row in rows] + [0])
+
+        ArrayFile.write(
+            cls.filepath(env),
+            {
+                'cells': cells,
+                'starts': starts,
+                'x': array.array('i', (row[1] for row in rows)),
+                'y': array.array('i', (row[2] for row in rows)),
+                'post_codes': post_codes
+            },
+            {'cell_size': cls.CELL_SIZE, 'max_ring': extent + 1}
+        )
+        return len(rows)
+
+    @classmethod
+    def cell(cls, coordinate: float) -> int:
+        return int(coordinate // cls.CELL_SIZE)
+
+    @classmethod
+    def cell_key(cls, column: int, row: int) -> int:
+        return row * cls.ROW_WIDTH + column
+
+    def post_code(self, i: int) -> str:
+        return bytes(self.post_codes[i * self.POST_CODE_WIDTH:(i + 1) * self.POST_CODE_WIDTH]).decode('ascii').strip()
+
+    def span(self, row: int, column_from: int, column_to: int) -> range:
+        """
+        :return: The indexes of the post codes in a horizontal run of cells
+        """
+        if row < 0 or column_to < 0:
+            return range(0)
+        lo = bisect.bisect_left(self.cells, self.cell_key(max(column_from, 0), row))
+        hi = bisect.bisect_right(self.cells, self.cell_key(column_to, row), lo)
+        return range(self.starts[lo], self.starts[hi])
+
+    def ring(self, column: int, row: int, r: int) -> Iterable[range]:
+        """
+        :return: The post code index ranges of the cells at a Chebyshev distance of r from the given cell
+        """
+        if r == 0:
+            yield self.span(row, column, column)
+            return
+        yield self.span(row - r, column - r, column + r)
+        yield self.span(row + r, column - r, column + r)
+        for ring_row in range(row - r + 1, row + r):
+            yield self.span(ring_row, column - r, column - r)
+            yield self.span(ring_row, column + r, column + r)
+
+    def nearest(self, x: float, y: float, k: int = 1) -> List[Tuple[str, float]]:
+        """
+        :return: The k post codes nearest the point, nearest first, with their distances from it in metres
+        """
+        (column, row) = (self.cell(x), self.cell(y))
+        best = []  # a max-heap (of negated squared distances) holding the k nearest post codes so far
+        for r in range(self.max_ring + max(abs(column), abs(row))):
+            for span in self.ring(column, row, r):
+                for i in span:
+                    d2 = (self.x[i] - x) ** 2 + (self.y[i] - y) ** 2
+                    if len(best) < k:
+                        heapq.heappush(best, (-d2, i))
+                    elif d2 < -best[0][0]:
+                        heapq.heapreplace(best, (-d2, i))
+            # Anything in a ring further out is at least r cells away
+            if len(best) == k and -best[0][0] <= (r * self.CELL_SIZE) ** 2:
+                break
+        return [(self.post_code(i), math.sqrt(-d2)) for (d2, i) in sorted(best, reverse=True)]
+
+    def within(self, x: float, y: float, radius: float) -> List[Tuple[str, float]]:
+        """
+        :return: The post codes within radius metres of the point, nearest first, with their distances from it
+        """
+        found = []
+        (column_from, column_to) = (self.cell(x - radius), self.cell(x + radius))
+        for row in range(self.cell(y - radius), self.cell(y + radius) + 1):
+            for i in self.span(row, column_from, column_to):
+                d2 = (self.x[i] - x) ** 2 + (self.y[i] - y) ** 2
+                if d2 <= radius ** 2:
+                    found.append((d2, i))
+        return [(self.post_code(i), math.sqrt(d2)) for (d2, i) in sorted(found)]
+
+    def nearest_batch(self, points: Iterable[Tuple[float, float]], k: int = 1) -> List[List[Tuple[str, float]]]:
+        return [self.nearest(x, y, k) for (x, y) in points]
+
+    def within_batch(self, points: Iterable[Tuple[float, float]], radius: float) -> List[List[Tuple[str, float]]]:
+        return [self.within(x, y, radius) for (x, y) in points]
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,104 @@
+from src.array_file import ArrayFile
+from src.environment import MyEnvironment
+from src.exceptions import NPMException
+from typing import Iterable, List, Union
+
+import array
+import os
+
+
+class PostCodeSnapshot(object):
+    """
+    A forward geocoder: where is a given post code?
+
+    The post_codes table is exported to a memory-mapped file of sorted, fixed-width post code keys with
+    parallel arrays of coordinates, grid reference sources and districts.
+    Looking up a post code is a binary search of the keys, so bulk lookups need no database connection at all.
+    The snapshot is regenerated whenever the post_codes table is rebuilt.
+    """
+    KEY_WIDTH = 8
+    NO_DISTRICT = -1
+    FILENAME = 'post-code-snapshot.dat'
+
+    def __init__(self, filepath: str):
+        """
+        :raises NPMException: if the snapshot has not been built
+        """
+        try:
+            self.snapshot = ArrayFile(filepath)
+        except (FileNotFoundError, ValueError) as e:
+            raise NPMException(f'Post code snapshot unavailable: {e}')
+        self.keys = self.snapshot['keys']
+        self.osx = self.snapshot['osx']
+        self.osy = self.snapshot['osy']
+        self.gr_source_ids = self.snapshot['gr_source_ids']
+        self.district_ids = self.snapshot['district_ids']
+        self.count = len(self.osx)
+
+    @classmethod
+    def filepath(cls, env: MyEnvironment) -> str:
+        return os.path.join(env.external_data_root, 'gazetteer', cls.FILENAME)
+
+    @classmethod
+    def build(cls, env: MyEnvironment) -> int:
+        """
+        (Re)build the snapshot from the post_codes table.
+        :return: The number of post codes in the snapshot
+        """
+        q = "select post_code, osx, osy, gr_source_id, district_id from post_codes"
+        c = env.dbc.cursor()
+        c.execute(q)
+        rows = sorted((cls.key(row[0]), row[1], row[2], row[3], row[4]) for row in c)
+        c.close()
+        ArrayFile.write(
+            cls.filepath(env),
+            {
+                'keys': b''.join(row[0] for row in rows),
+                'osx': array.array('i', (row[1] for row in rows)),
+                'osy': array.array('i', (row[2] for row in rows)),
+                'gr_source_ids': array.array('i', (row[3] for row in rows)),
+                'district_ids': array.array('i', (cls.NO_DISTRICT if row[4] is None else row[4] for row in rows))
+            },
+            {'key_width': cls.KEY_WIDTH}
+        )
+        return len(rows)
+
+    @classmethod
+    def key(cls, post_code: str) -> bytes:
+        """
+        The fixed-width key of a post code given in any of the usual formats: 'ab10 1aa', 'AB101AA', 'AB10  1AA'.
+        """
+        p = ''.join(post_code.split()).upper()
+        return f'{p[:-3]} {p[-3:]}'.encode('ascii', 'replace').ljust(cls.KEY_WIDTH)[:cls.KEY_WIDTH]
+
+    def position(self, post_code: str) -> Union[int, None]:
+        """
+        :return: The post code's position in the snapshot or None if it is not there
+        """
+        key = self.key(post_code)
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys[mid * self.KEY_WIDTH:(mid + 1) * self.KEY_WIDTH].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.keys[lo * self.KEY_WIDTH:(lo + 1) * self.KEY_WIDTH].tobytes() == key:
+            return lo
+        return None
+
+    def lookup(self, post_code: str) -> Union[tuple, None]:
+        """
+        :return: A tuple of the post code's osx, osy, gr_source_id and district_id or None if it is unknown
+        """
+        i = self.position(post_code)
+        if i is None:
+            return None
+        district_id = self.district_ids[i]
+        return self.osx[i], self.osy[i], self.gr_source_ids[i], None if district_id == self.NO_DISTRICT else district_id
+
+    def lookup_batch(self, post_codes: Iterable[str]) -> List[Union[tuple, None]]:
+        return [self.lookup(post_code) for post_code in post_codes]
+
+    def close(self):
+        self.snapshot.close()
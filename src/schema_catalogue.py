@@ -0,0 +1,113 @@
+from collections import namedtuple
+from typing import Union
+
+import threading
+
+
+CatalogueColumn = namedtuple('CatalogueColumn', ['name', 'data_type', 'column_type', 'is_nullable', 'column_key'])
+
+
+class SchemaCatalogue(object):
+    """
+    The columns, types and primary keys of every table in the database, read from information_schema once per run.
+    Queries against information_schema can be slow on a busy server, so the whole schema is loaded in a single query
+    the first time anything is asked of the catalogue and is then shared by all the tables (and all the threads).
+    A table whose structure is changed, by running its DDL, must be invalidated:
+    it is then reloaded on its own when next used.
+    A task which is about to change the structure of the tables it uses, and so would have to reload them anyway,
+    should rather load them one at a time (see load_individually).
+    """
+    QUERY = (
+        "select c.table_name, c.column_name, c.data_type, c.column_type, c.is_nullable, c.column_key, "
+        "k.ordinal_position "
+        "from information_schema.columns c "
+        "left join information_schema.key_column_usage k on k.table_schema = c.table_schema "
+        "and k.table_name = c.table_name and k.column_name = c.column_name and k.constraint_name = 'PRIMARY' "
+        "where c.table_schema = %s{} "
+        "order by c.table_name, c.ordinal_position"
+    )
+
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.tables = None
+        self.primary_keys = None
+        self.lock = threading.Lock()
+
+    def load(self, dbc, table_name: Union[str, None] = None):
+        """
+        Load the whole schema or, if a table is named, just that table.
+        :param dbc: the database connection to query
+        :param table_name:
+        """
+        if table_name is None:
+            q = self.QUERY.format('')
+            params = (self.database_name, )
+        else:
+            q = self.QUERY.format(' and c.table_name = %s')
+            params = (self.database_name, table_name)
+        c = dbc.cursor()
+        c.execute(q, params)
+        rows = c.fetchall()
+        c.close()
+
+        tables = {} if table_name is None else {table_name: []}
+        key_positions = {}
+        for (row_table_name, column_name, data_type, column_type, is_nullable, column_key, key_position) in rows:
+            tables.setdefault(row_table_name, []).append(
+                CatalogueColumn(column_name, data_type, column_type, is_nullable == 'YES', column_key)
+            )
+            if key_position is not None:
+                key_positions.setdefault(row_table_name, []).append((key_position, column_name))
+        primary_keys = {
+            name: [column_name for (_, column_name) in sorted(key_positions.get(name, []))] for name in tables
+        }
+
+        if table_name is None:
+            (self.tables, self.primary_keys) = (tables, primary_keys)
+        else:
+            self.tables.update(tables)
+            self.primary_keys.update(primary_keys)
+
+    def load_individually(self):
+        """
+        Start with an empty catalogue so that each table is loaded on its own when it is first used,
+        rather than the whole schema being loaded at once.
+        """
+        with self.lock:
+            (self.tables, self.primary_keys) = ({}, {})
+
+    def columns(self, dbc, table_name: str) -> list:
+        """
+        :param dbc: the database connection to use should the catalogue need (re)loading
+        :param table_name:
+        :return: The table's columns, in order, as CatalogueColumn tuples: an empty list if the table does not exist
+        """
+        with self.lock:
+            self.ensure_loaded(dbc, table_name)
+            return self.tables[table_name]
+
+    def column_names(self, dbc, table_name: str) -> list:
+        return [column.name for column in self.columns(dbc, table_name)]
+
+    def primary_key(self, dbc, table_name: str) -> list:
+        """
+        :return: The names of the table's primary key columns in key order: an empty list if it has no primary key
+        """
+        with self.lock:
+            self.ensure_loaded(dbc, table_name)
+            return self.primary_keys[table_name]
+
+    def ensure_loaded(self, dbc, table_name: str):
+        if self.tables is None:
+            self.load(dbc)
+        if table_name not in self.tables:
+            self.load(dbc, table_name)
+
+    def invalidate(self, table_name: str):
+        """
+        Forget what is known of a table, for example after its DDL has been run.
+        """
+        with self.lock:
+            if self.tables is not None:
+                self.tables.pop(table_name, None)
+                self.primary_keys.pop(table_name, None)
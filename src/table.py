@@ -1,14 +1,41 @@
 import os
+import mysql.connector
 import mysql.connector.errors
+import contextlib
 import csv
+import datetime
+import decimal
+import gzip
+import io
+import re
+import shutil
+import tempfile
 import uuid
 
+from src.column_file import ColumnFileReader, ColumnFileWriter
 from src.entity_name import EntityName
 from src.exceptions import *
 from src.environment import MyEnvironment
+from typing import Iterable
 
 
 class Table(object):
+    EXPORT_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+    # The temporary table through which apply_diff updates changed rows
+    DIFF_TABLE = '{}_changes'
+    # Table definitions in a CREATE TABLE statement which can be added after the data have been loaded
+    DEFERRABLE_DEFINITION = re.compile(
+        r'^(?:constraint\s+(?:`[^`]+`|\w+)\s+)?(?:unique|key|index|fulltext|spatial|foreign\s+key)\b',
+        re.IGNORECASE
+    )
+    INTEGER_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'year'}
+    REAL_TYPES = {'float', 'double', 'real'}
+    DECIMAL_TYPES = {'decimal', 'numeric'}
+    BINARY_TYPES = {'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob'}
+    CHARACTER_TYPES = {'char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext', 'enum', 'set'}
+    DATETIME_TYPES = {'datetime', 'timestamp'}
+    TIME_VALUE = re.compile(r'(?:(-?\d+) days?, )?(-)?(\d+):(\d\d):(\d\d)(?:\.(\d{1,6}))?')
+
     def __init__(self, env: MyEnvironment, table_name: str, table_metadata: dict):
         self.env = env
         self.table_name = table_name
@@ -28,30 +55,261 @@ class Table(object):
             'export',
             f'{table_name}.csv'
         )
+        self.binary_export_filepath = os.path.join(
+            self.env.npadb_data_root,
+            'export',
+            f'{table_name}.columns'
+        )
         self.record_count = 0
+        self.import_converter = self.compiled_import_converter()
+        self.load_converter = self.compiled_import_converter(convert_uuids=False)
 
-    def export(self):
+    def export(self, batch_size: int = 1000, compression: str = None) -> bool:
         """
-        Export the data, row by row, from the database to the csv text file.
+        Export the data from the database to the csv text file.
+        The rows are streamed from an unbuffered cursor in batches so memory use is the same whatever the table's size.
         Report the number of records exported from the table.
         If there is a database error, halt the export of this table but do not stop the whole program.
+        :param batch_size: the number of rows fetched from the database at a time
+        :param compression: None, 'gzip' or 'zstd'
+        :return: True if the table was exported without error
         """
         query = f"select * from {self.table_name}"
-        c = self.env.dbc.cursor()
         record_count = 0
         try:
-            c.execute(query)
+            record_count = self.exported_rows(
+                self.compressed_export_filepath(compression), query, (), batch_size, compression
+            )
         except mysql.connector.errors.ProgrammingError as e:
             self.env.msg.warning(f"Database Error: {e.msg}")
+            return False
         else:
-            with open(self.export_filepath, 'w', newline='') as f:
-                writer = csv.writer(f, delimiter='\t')
-                for row in c:
-                    writer.writerow(self.value_conversions_export(row))
-                    record_count += 1
+            return True
         finally:
             self.env.msg.info(f"Records exported from '{self.table_name}' table = {record_count}")
+
+    def exported_rows(self, filepath: str, query: str, params: tuple, batch_size: int, compression: str) -> int:
+        """
+        Run an export query and write its rows to a file.
+        The file is not created unless the query succeeds.
+        :return: The number of rows exported
+        """
+        c = self.env.dbc.cursor(buffered=False)
+        record_count = 0
+        try:
+            c.execute(query, params)
+            with self.export_file(filepath, compression) as f:
+                writer = csv.writer(f, delimiter='\t')
+                while True:
+                    rows = c.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    writer.writerows(self.value_conversions_export(row) for row in rows)
+                    record_count += len(rows)
+        finally:
+            c.close()
+        return record_count
+
+    def export_part(self, part: int, key_column: str, lower, upper, batch_size: int, compression: str) -> int:
+        """
+        Export the rows of one primary key range of the table, in key order, to a part file.
+        :param part: the part number
+        :param key_column: the (first) primary key column
+        :param lower: the range's lowest key or None if the range is open below
+        :param upper: the key after the range's highest or None if the range is open above
+        :param batch_size:
+        :param compression:
+        :return: The number of rows exported
+        """
+        conditions = []
+        params = []
+        if lower is not None:
+            conditions.append(f'`{key_column}` >= %s')
+            params.append(lower)
+        if upper is not None:
+            conditions.append(f'`{key_column}` < %s')
+            params.append(upper)
+        query = f"select * from {self.table_name}"
+        if len(conditions) > 0:
+            query += f" where {' and '.join(conditions)}"
+        query += f" order by `{key_column}`"
+        return self.exported_rows(self.part_filepath(part, compression), query, tuple(params), batch_size, compression)
+
+    def part_filepath(self, part: int, compression: str = None) -> str:
+        return f'{self.export_filepath}.part{part:03}{self.EXPORT_SUFFIXES[compression]}'
+
+    def concatenate_parts(self, part_count: int, compression: str = None):
+        """
+        Join the part files, in key order, into the export file and remove them.
+        Concatenated gzip members and zstd frames are themselves valid compressed files,
+        so compressed parts can be joined without being decompressed.
+        """
+        with open(self.compressed_export_filepath(compression), 'wb') as f:
+            for part in range(part_count):
+                with open(self.part_filepath(part, compression), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+                os.remove(self.part_filepath(part, compression))
+
+    def remove_parts(self, part_count: int, compression: str = None):
+        """
+        Remove whichever part files were written, for example when another part of the table failed.
+        """
+        for part in range(part_count):
+            try:
+                os.remove(self.part_filepath(part, compression))
+            except FileNotFoundError:
+                pass
+
+    def estimated_row_count(self) -> int:
+        """
+        :return: The storage engine's estimate of the number of rows in the table, which is quick to obtain
+        """
+        q = "select table_rows from information_schema.tables where table_schema = %s and table_name = %s"
+        c = self.env.dbc.cursor(buffered=True)
+        c.execute(q, (self.env.database_name, self.table_name))
+        row = c.fetchone()
+        c.close()
+        return 0 if row is None or row[0] is None else row[0]
+
+    def primary_key_column(self):
+        """
+        :return: The name of the first column of the table's primary key or None if it has no primary key
+        """
+        primary_key = self.env.schema_catalogue.primary_key(self.env.dbc, self.table_name)
+        return primary_key[0] if len(primary_key) > 0 else None
+
+    def chunk_boundaries(self, key_column: str, row_count: int, chunks: int) -> list:
+        """
+        Divide the table into (roughly) equal primary key ranges.
+        :return: The first key of each range after the first, in ascending order
+        """
+        boundaries = []
+        q = f"select `{key_column}` from {self.table_name} order by `{key_column}` limit 1 offset %s"
+        c = self.env.dbc.cursor(buffered=True)
+        for i in range(1, chunks):
+            c.execute(q, (row_count * i // chunks, ))
+            row = c.fetchone()
+            if row is not None and (len(boundaries) == 0 or row[0] > boundaries[-1]):
+                boundaries.append(row[0])
+        c.close()
+        return boundaries
+
+    def export_binary(self, batch_size: int = 1000) -> bool:
+        """
+        Export the data from the database to a binary column file, keeping the values' types.
+        Each batch of rows fetched from the database is written as a batch of the file.
+        Report the number of records exported from the table.
+        If there is a database error, halt the export of this table but do not stop the whole program.
+        :param batch_size: the number of rows fetched from the database at a time
+        :return: True if the table was exported without error
+        """
+        columns = self.env.schema_catalogue.columns(self.env.dbc, self.table_name)
+        column_types = self.binary_column_types()
+        c = self.env.dbc.cursor(buffered=False)
+        record_count = 0
+        try:
+            c.execute(f"select {', '.join(f'`{column.name}`' for column in columns)} from {self.table_name}")
+            writer = ColumnFileWriter(
+                self.binary_export_filepath,
+                [(column.name, column_type) for (column, column_type) in zip(columns, column_types)]
+            )
+            try:
+                while True:
+                    rows = c.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    writer.write_batch([self.binary_values(row, column_types) for row in rows])
+                    record_count += len(rows)
+            except BaseException:
+                writer.abandon()
+                raise
+            writer.close()
+        except mysql.connector.errors.ProgrammingError as e:
+            self.env.msg.warning(f"Database Error: {e.msg}")
+            return False
+        else:
+            return True
+        finally:
             c.close()
+            self.env.msg.info(f"Records exported from '{self.table_name}' table = {record_count}")
+
+    def binary_column_types(self) -> list:
+        """
+        The column file types of the table's columns (as the catalogue has them).
+        UUIDs are kept as their 16 bytes; anything which is not a number or binary data is held as text.
+        """
+        uuid_fields = set(self.table_metadata['uuid_fields'])
+        column_types = []
+        for (i, column) in enumerate(self.env.schema_catalogue.columns(self.env.dbc, self.table_name)):
+            if i in uuid_fields:
+                column_types.append('uuid')
+            elif column.data_type == 'bit' or (
+                    column.data_type in self.INTEGER_TYPES and
+                    not (column.data_type == 'bigint' and 'unsigned' in column.column_type)
+            ):
+                column_types.append('int')
+            elif column.data_type in self.REAL_TYPES:
+                column_types.append('float')
+            elif column.data_type in self.BINARY_TYPES:
+                column_types.append('bytes')
+            else:
+                column_types.append('text')
+        return column_types
+
+    @staticmethod
+    def binary_values(row: tuple, column_types: list) -> list:
+        """
+        Convert the values of a row to the types in which they are held in a column file.
+        """
+        values = list(row)
+        for (i, column_type) in enumerate(column_types):
+            value = values[i]
+            if column_type != 'text' or value is None or isinstance(value, str):
+                continue
+            if isinstance(value, (bytes, bytearray)):
+                values[i] = value.decode('utf-8')
+            elif isinstance(value, set):
+                values[i] = ','.join(sorted(value))
+            elif isinstance(value, datetime.timedelta):
+                values[i] = Table.time_value(value)
+            else:
+                values[i] = str(value)
+        return values
+
+    @staticmethod
+    def time_value(value: datetime.timedelta) -> str:
+        """
+        Format a TIME value, which the connector returns as a timedelta, as [-]HH:MM:SS[.ffffff].
+        The str() of a timedelta of a day or more, or of a negative one, is not a TIME literal.
+        """
+        sign = '-' if value < datetime.timedelta(0) else ''
+        microseconds = abs(value) // datetime.timedelta(microseconds=1)
+        (seconds, microseconds) = divmod(microseconds, 1000000)
+        (minutes, seconds) = divmod(seconds, 60)
+        (hours, minutes) = divmod(minutes, 60)
+        fraction = f'.{microseconds:06}' if microseconds > 0 else ''
+        return f'{sign}{hours:02}:{minutes:02}:{seconds:02}{fraction}'
+
+    def compressed_export_filepath(self, compression: str = None) -> str:
+        return self.export_filepath + self.EXPORT_SUFFIXES[compression]
+
+    def export_file(self, filepath: str, compression: str = None):
+        """
+        Open an export file for writing as text, compressing it on the fly if required.
+        :param filepath:
+        :param compression: None, 'gzip' or 'zstd'
+        :raises NPMException: if zstd compression is requested but the zstandard package is not installed
+        """
+        if compression == 'gzip':
+            return gzip.open(filepath, 'wt', newline='')
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise NPMException('zstd compression requires the zstandard package')
+            writer = zstandard.ZstdCompressor().stream_writer(open(filepath, 'wb'))
+            return io.TextIOWrapper(writer, newline='')
+        return open(filepath, 'w', newline='')
 
     def value_conversions_export(self, retrieved_row: tuple) -> list:
         row = list(retrieved_row)
@@ -59,7 +317,13 @@ class Table(object):
             row[field] = uuid.UUID(bytes=bytes(row[field]))
         return row
 
-    def create_table(self):
+    def create_table(self, defer_indexes: bool = False) -> list:
+        """
+        (Re)create the table by running its DDL file.
+        :param defer_indexes: True if the table is to be created with its primary key but none of its other indexes
+        (or foreign keys) so that they can be added, with add_deferred_indexes, once the data have been loaded
+        :return: The definitions of the deferred indexes, if any
+        """
         try:
             with open(self.ddl_filepath, 'r') as f:
                 sql_file = f.read()
@@ -69,12 +333,401 @@ class Table(object):
         q = 'DROP TABLE IF EXISTS {}'.format(self.table_name)
         c.execute(q)
         statements = sql_file.split(';')
+        deferred_definitions = []
         for q in [item.strip() for item in statements]:
             if len(q) > 0:
-                c.execute(q)
+                if defer_indexes:
+                    (q, definitions) = self.deferred_index_ddl(q)
+                    deferred_definitions += definitions
+                if q is not None:
+                    c.execute(q)
+        c.close()
+        self.env.schema_catalogue.invalidate(self.table_name)
+        return deferred_definitions
+
+    def deferred_index_ddl(self, statement: str) -> tuple:
+        """
+        Take the secondary indexes and foreign keys out of the table's CREATE TABLE statement
+        and hold back any CREATE INDEX statement on the table altogether.
+        Other statements are returned unchanged.
+        :return: A tuple of the statement (None if it is held back) and a list of the definitions taken out of it
+        """
+        match = re.match(
+            r'create\s+((?:unique\s+|fulltext\s+|spatial\s+)?index\s+(?:`[^`]+`|\w+))\s+on\s+`?(\w+)`?\s*(.*)$',
+            statement,
+            re.IGNORECASE | re.DOTALL
+        )
+        if match is not None and match.group(2) == self.table_name:
+            return None, [f'{match.group(1)} {match.group(3)}']
+        match = re.search(
+            r'create\s+(?:temporary\s+)?table\s+(?:if\s+not\s+exists\s+)?`?(\w+)`?\s*\(', statement, re.IGNORECASE
+        )
+        if match is None or match.group(1) != self.table_name:
+            return statement, []
+        body_start = match.end()
+        (definitions, body_end) = self.split_definitions(statement, body_start)
+        kept = []
+        deferred = []
+        for definition in definitions:
+            if self.DEFERRABLE_DEFINITION.match(definition):
+                deferred.append(definition)
+            else:
+                kept.append(definition)
+        return statement[:body_start] + '\n  ' + ',\n  '.join(kept) + '\n' + statement[body_end:], deferred
+
+    @staticmethod
+    def split_definitions(statement: str, body_start: int) -> tuple:
+        """
+        Split the body of a CREATE TABLE statement at the commas which separate its column and index definitions,
+        ignoring commas in parentheses or quotes.
+        The body ends at the parenthesis which closes the one before body_start,
+        so parentheses in the table options after it (a comment or a partitioning clause) are left alone.
+        :param statement:
+        :param body_start: the index of the first character after the body's opening parenthesis
+        :return: A tuple of the list of definitions and the index of the body's closing parenthesis
+        :raises ValueError: if the body's parenthesis is never closed
+        """
+        definitions = []
+        depth = 0
+        quote = None
+        start = body_start
+        for i in range(body_start, len(statement)):
+            character = statement[i]
+            if quote is not None:
+                if character == quote:
+                    quote = None
+            elif character in '\'"`':
+                quote = character
+            elif character == '(':
+                depth += 1
+            elif character == ')':
+                if depth == 0:
+                    definitions.append(statement[start:i].strip())
+                    return [definition for definition in definitions if len(definition) > 0], i
+                depth -= 1
+            elif character == ',' and depth == 0:
+                definitions.append(statement[start:i].strip())
+                start = i + 1
+        raise ValueError('Unterminated CREATE TABLE body')
+
+    def add_deferred_indexes(self, definitions: list):
+        """
+        Add the indexes and foreign keys held back by create_table in a single ALTER TABLE statement,
+        so that the table's data are read once however many indexes there are.
+        """
+        if len(definitions) == 0:
+            return
+        self.env.msg.info(f"Adding {len(definitions)} deferred indexes to '{self.table_name}' table")
+        c = self.env.dbc.cursor()
+        c.execute(f"alter table {self.table_name} {', '.join(f'add {definition}' for definition in definitions)}")
         c.close()
+        self.env.schema_catalogue.invalidate(self.table_name)
+
+    @contextlib.contextmanager
+    def bulk_load_session(self):
+        """
+        Turn off unique checks and autocommit for the duration of a load so that the rows go in as one transaction
+        without InnoDB checking them against any unique secondary index as it goes.
+        """
+        autocommit = self.env.dbc.autocommit
+        c = self.env.dbc.cursor()
+        c.execute('SET SESSION unique_checks = 0')
+        self.env.dbc.autocommit = False
+        try:
+            yield
+        finally:
+            self.env.dbc.autocommit = autocommit
+            c.execute('SET SESSION unique_checks = 1')
+            c.close()
 
-    def populate_table(self):
+    def primary_key_order(self):
+        """
+        The sort key which puts converted rows into primary key order.
+        Key values are normalised as their catalogue types require (see value_normalisers)
+        so that rows from the csv file and rows from the database are ordered alike.
+        :return: A function of a converted row
+        """
+        columns = self.env.schema_catalogue.columns(self.env.dbc, self.table_name)
+        positions = {column.name: i for (i, column) in enumerate(columns)}
+        normalisers = self.value_normalisers()
+        key_fields = [
+            (positions[column_name], normalisers[positions[column_name]])
+            for column_name in self.env.schema_catalogue.primary_key(self.env.dbc, self.table_name)
+        ]
+
+        def key(row: list) -> tuple:
+            # Nulls come first and are never compared with values
+            return tuple((False, ) if row[i] is None else (True, normalised(row[i])) for (i, normalised) in key_fields)
+
+        return key
+
+    def value_normalisers(self) -> list:
+        """
+        A function for each column of the table which brings a (non-null) value, as converted from the csv file
+        or as returned by the database, into a single form that can be compared and ordered:
+        numbers as numbers (so that 1.50 equals 1.5), UUIDs and binary data as bytes,
+        text as str, dates and datetimes as ISO 8601 text and times as timedeltas.
+        :return: The functions in column order
+        """
+        columns = self.env.schema_catalogue.columns(self.env.dbc, self.table_name)
+        uuid_fields = set(self.table_metadata['uuid_fields'])
+        normalisers = []
+        for (i, column) in enumerate(columns):
+            if i in uuid_fields:
+                normalisers.append(
+                    lambda value: bytes(value) if isinstance(value, (bytes, bytearray)) else uuid.UUID(value).bytes
+                )
+            elif column.data_type in self.INTEGER_TYPES:
+                normalisers.append(int)
+            elif column.data_type in self.REAL_TYPES:
+                normalisers.append(float)
+            elif column.data_type in self.DECIMAL_TYPES:
+                normalisers.append(decimal.Decimal)
+            elif column.data_type in self.BINARY_TYPES:
+                normalisers.append(
+                    lambda value: value.encode('utf-8') if isinstance(value, str) else bytes(value)
+                )
+            elif column.data_type == 'date':
+                normalisers.append(self.normalised_date)
+            elif column.data_type in self.DATETIME_TYPES:
+                normalisers.append(self.normalised_datetime)
+            elif column.data_type == 'time':
+                normalisers.append(self.normalised_time)
+            else:
+                normalisers.append(self.normalised_text)
+        return normalisers
+
+    @staticmethod
+    def normalised_text(value) -> str:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (bytes, bytearray)):
+            return value.decode('utf-8')
+        if isinstance(value, set):
+            return ','.join(sorted(value))
+        return str(value)
+
+    @staticmethod
+    def normalised_date(value) -> str:
+        """
+        Dates as ISO 8601 text, which sorts in date order.
+        Text which is not a valid date (such as MySQL's zero date) is left as it is.
+        """
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        try:
+            return datetime.date.fromisoformat(value).isoformat()
+        except ValueError:
+            return value
+
+    @staticmethod
+    def normalised_datetime(value) -> str:
+        """
+        Datetimes as ISO 8601 text, with a space between the date and the time, which sorts in time order.
+        Text which is not a valid datetime (such as MySQL's zero datetime) is left as it is.
+        """
+        if isinstance(value, datetime.datetime):
+            return value.isoformat(' ')
+        try:
+            return datetime.datetime.fromisoformat(value).isoformat(' ')
+        except ValueError:
+            return value
+
+    @classmethod
+    def normalised_time(cls, value) -> datetime.timedelta:
+        """
+        Times as the timedeltas in which the database returns them.
+        Text may be a TIME literal, [-]HH:MM:SS[.ffffff], or the str() of a timedelta.
+        :raises ValueError: if the text is neither
+        """
+        if isinstance(value, datetime.timedelta):
+            return value
+        match = cls.TIME_VALUE.fullmatch(value)
+        if match is None:
+            raise ValueError(f"'{value}' is not a time")
+        (days, sign, hours, minutes, seconds, fraction) = match.groups()
+        time = datetime.timedelta(
+            hours=int(hours), minutes=int(minutes), seconds=int(seconds),
+            microseconds=int((fraction or '').ljust(6, '0'))
+        )
+        return datetime.timedelta(days=int(days or 0)) + (-time if sign else time)
+
+    def apply_diff(self, batch_size: int = 1000):
+        """
+        Bring the existing table into line with the csv text file without rebuilding it.
+        The converted rows of the file and the rows of the table are merged in primary key order
+        (character keys are ordered by their bytes on both sides):
+        rows only in the file are inserted,
+        rows only in the table are deleted and
+        rows whose values differ, once normalised by their columns' types, are updated in place by primary key.
+        All other rows are left untouched.
+        The table is read from a connection of its own, so the changes can be written, a batch at a time,
+        while the merge runs: deletes as a single statement per batch, inserts as a multi-row insert
+        and updates as a multi-row insert into a temporary table which is then joined to the table.
+        The file is only held in memory if its rows are not already in primary key order.
+        The changes are committed as a single transaction, so the table remains online throughout,
+        but should a change collide with a unique secondary key the transaction is rolled back
+        and the table must be rebuilt.
+        The table's structure is not changed: if its DDL has changed it must be rebuilt.
+        :param batch_size: the number of rows deleted, updated or inserted at a time
+        :raises NPMException: if the table has no primary key, the file's rows do not match its columns
+        or a value in the file is not of its column's type
+        """
+        column_names = self.column_names()
+        primary_key = self.env.schema_catalogue.primary_key(self.env.dbc, self.table_name)
+        if len(primary_key) == 0:
+            raise NPMException(f"Table '{self.table_name}' has no primary key so its changes cannot be applied")
+        try:
+            values_function = getattr(self, f'values_{self.table_name}')
+        except AttributeError:
+            values_function = self.import_converter
+        order = self.primary_key_order()
+        normalisers = self.value_normalisers()
+        # A first pass over the file checks every value, so that a bad one is found before anything is written,
+        # and whether the rows are already in key order
+        in_key_order = True
+        last_key = None
+        try:
+            for row in self.diff_rows(values_function):
+                if len(row) != len(column_names):
+                    raise NPMException(
+                        f"The rows of '{self.table_name}.csv' do not match the columns of the table: it must be rebuilt"
+                    )
+                self.compared_values(row, normalisers)
+                key = order(row)
+                if last_key is not None and key < last_key:
+                    in_key_order = False
+                last_key = key
+        except FileNotFoundError:
+            self.env.msg.warning(f"Import file '{self.table_name}.csv' not found in '{self.table_metadata['group']}'")
+            return
+        except (ValueError, decimal.InvalidOperation) as e:
+            raise NPMException(f"The rows of '{self.table_name}.csv' cannot be compared with the table: {e}")
+        if in_key_order:
+            current_rows = self.diff_rows(values_function)
+        else:
+            current_rows = iter(sorted(self.diff_rows(values_function), key=order))
+
+        columns = self.env.schema_catalogue.columns(self.env.dbc, self.table_name)
+        positions = {column.name: i for (i, column) in enumerate(columns)}
+        key_positions = [positions[column_name] for column_name in primary_key]
+        ordering = ', '.join(
+            f'cast(`{column_name}` as binary)' if columns[positions[column_name]].data_type in self.CHARACTER_TYPES
+            else f'`{column_name}`'
+            for column_name in primary_key
+        )
+        pending = {'new': [], 'changed': [], 'deleted': []}
+        counts = {'new': 0, 'changed': 0, 'deleted': 0}
+        reader = mysql.connector.connect(**self.env.connection_parameters())
+        rc = reader.cursor(buffered=False)
+        c = self.env.dbc.cursor()
+        try:
+            c.execute(f"drop temporary table if exists {self.DIFF_TABLE.format(self.table_name)}")
+            c.execute(f"create temporary table {self.DIFF_TABLE.format(self.table_name)} like {self.table_name}")
+            rc.execute(
+                f"select {', '.join(f'`{column_name}`' for column_name in column_names)} "
+                f"from {self.table_name} order by {ordering}"
+            )
+            previous_rows = self.fetched_rows(rc, batch_size)
+            previous = next(previous_rows, None)
+            current = next(current_rows, None)
+            while previous is not None or current is not None:
+                if current is None or (previous is not None and order(previous) < order(current)):
+                    pending['deleted'].append(tuple(previous[i] for i in key_positions))
+                    previous = next(previous_rows, None)
+                elif previous is None or order(current) < order(previous):
+                    pending['new'].append(current)
+                    current = next(current_rows, None)
+                else:
+                    if self.compared_values(previous, normalisers) != self.compared_values(current, normalisers):
+                        pending['changed'].append(current)
+                    previous = next(previous_rows, None)
+                    current = next(current_rows, None)
+                if max(len(rows) for rows in pending.values()) >= batch_size:
+                    self.apply_diff_batch(c, pending, counts, primary_key)
+            self.apply_diff_batch(c, pending, counts, primary_key)
+            c.execute(f"drop temporary table {self.DIFF_TABLE.format(self.table_name)}")
+        except BaseException:
+            self.env.dbc.rollback()
+            raise
+        else:
+            self.env.dbc.commit()
+        finally:
+            c.close()
+            rc.close()
+            reader.close()
+        self.env.msg.info(
+            f"Changes applied to '{self.table_name}' table: {counts['new']:,} new, {counts['changed']:,} changed, "
+            f"{counts['deleted']:,} deleted"
+        )
+
+    def diff_rows(self, values_function) -> Iterable[list]:
+        """
+        :return: The converted rows of the csv text file, read as they are needed
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with open(self.data_filepath, newline='') as f:
+            for row in csv.reader(f, delimiter='\t'):
+                values = values_function(row)
+                if values is not None:
+                    yield values
+
+    def apply_diff_batch(self, cursor, pending: dict, counts: dict, primary_key: list):
+        """
+        Write a batch of the changes found by apply_diff to the table and clear them.
+        mysql-connector only sends a multi-row statement from executemany() for an INSERT,
+        so deletes name all their keys in one statement and changed rows are inserted into the temporary table
+        and then copied into the table with a single joined update.
+        :param cursor:
+        :param pending: the new and changed rows and the keys of the deleted rows, keyed by 'new', 'changed' and
+        'deleted'
+        :param counts: the running counts of the changes made, keyed in the same way
+        :param primary_key: the names of the primary key columns
+        """
+        diff_table = self.DIFF_TABLE.format(self.table_name)
+        if len(pending['deleted']) > 0:
+            row_placeholder = f"({', '.join(['%s'] * len(primary_key))})"
+            cursor.execute(
+                f"delete from {self.table_name} where ({', '.join(f'`{name}`' for name in primary_key)}) "
+                f"in ({', '.join([row_placeholder] * len(pending['deleted']))})",
+                [value for key in pending['deleted'] for value in key]
+            )
+        if len(pending['changed']) > 0:
+            cursor.executemany(self.data_insert_statement(diff_table), pending['changed'])
+            joined = ' and '.join(f't.`{name}` = d.`{name}`' for name in primary_key)
+            updates = ', '.join(f't.`{name}` = d.`{name}`' for name in self.column_names() if name not in primary_key)
+            cursor.execute(f"update {self.table_name} t join {diff_table} d on {joined} set {updates}")
+            cursor.execute(f"delete from {diff_table}")
+        if len(pending['new']) > 0:
+            cursor.executemany(self.data_insert_statement(), pending['new'])
+        for (kind, rows) in pending.items():
+            counts[kind] += len(rows)
+            rows.clear()
+
+    @staticmethod
+    def fetched_rows(cursor, batch_size: int):
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                return
+            yield from rows
+
+    @staticmethod
+    def compared_values(row, normalisers: list) -> list:
+        """
+        The values of a row (from the database or converted from the csv file) in a form in which they can be compared.
+        :param row:
+        :param normalisers: the table's value_normalisers
+        """
+        return [value if value is None else normalised(value) for (value, normalised) in zip(row, normalisers)]
+
+    def populate_table(self, batch_size: int = 1000, sort_rows: bool = False):
+        """
+        Insert the data from the csv text file into the table.
+        Converted rows are collected into batches which are sent to the database as multi-row inserts.
+        :param batch_size: the number of rows in each multi-row insert
+        :param sort_rows: True if the rows are to be sorted into primary key order before they are inserted
+        """
         values_function = None
         generic_function = 'value_conversions_import'
         try:
@@ -84,7 +737,7 @@ class Table(object):
         except AttributeError:
             # No bespoke field value conversion method exists,
             # so fallback to the generic method which is guided by table metadata
-            values_function = getattr(self, generic_function)
+            values_function = self.import_converter
             self.env.msg.debug(f"Using generic data conversion method '{generic_function}'")
         finally:
             # populate the table
@@ -93,11 +746,20 @@ class Table(object):
             record_count = 0
             try:
                 with open(self.data_filepath, newline='') as f:
-                    for row in csv.reader(f, delimiter='\t'):
-                        values = values_function(row)
-                        if values is not None:
-                            c.execute(q, values)
-                            record_count += 1
+                    rows = (values_function(row) for row in csv.reader(f, delimiter='\t'))
+                    rows = (values for values in rows if values is not None)
+                    if sort_rows:
+                        rows = sorted(rows, key=self.primary_key_order())
+                    batch = []
+                    for values in rows:
+                        batch.append(values)
+                        if len(batch) >= batch_size:
+                            c.executemany(q, batch)
+                            record_count += len(batch)
+                            batch = []
+                    if len(batch) > 0:
+                        c.executemany(q, batch)
+                        record_count += len(batch)
             except FileNotFoundError:
                 self.env.msg.warning(
                     f"Import file '{self.table_name}.csv' not found in '{self.table_metadata['group']}'"
@@ -107,18 +769,145 @@ class Table(object):
                 self.env.dbc.commit()
                 self.env.msg.info(f"Records inserted into '{self.table_name}' table = {record_count}")
 
-    def data_insert_statement(self):
-        q1 = "select column_name from information_schema.columns "
-        q1 += "where table_schema = 'all_the_stations' "
-        q1 += f"and table_name = '{self.table_name}' "
-        q1 += "order by ordinal_position"
+    def populate_table_binary(self, batch_size: int = 1000):
+        """
+        Insert the data from the table's binary column file (in the export directory) into the table.
+        The values are already of the types the database expects so they need no conversion.
+        :param batch_size: the number of rows in each multi-row insert
+        :raises NPMException: if the file is not a column file
+        """
+        try:
+            reader = ColumnFileReader(self.binary_export_filepath)
+        except ValueError as e:
+            raise NPMException(e)
+        field_list = ', '.join(f'`{column_name}`' for column_name in reader.column_names)
+        placeholders = ', '.join(['%s'] * len(reader.column_names))
+        q = f'insert into {self.table_name} ({field_list}) values ({placeholders})'
         c = self.env.dbc.cursor()
-        c.execute(q1)
-        field_list = [f"`{x[0]}`" for x in c.fetchall()]
-        c.close()
+        record_count = 0
+        try:
+            batch = []
+            for row in reader.rows():
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    c.executemany(q, batch)
+                    record_count += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                c.executemany(q, batch)
+                record_count += len(batch)
+        finally:
+            reader.close()
+            c.close()
+            self.env.dbc.commit()
+            self.env.msg.info(f"Records inserted into '{self.table_name}' table = {record_count}")
+
+    def has_bespoke_conversion(self) -> bool:
+        """
+        :return: True if the table's data are converted by a bespoke values_<table_name> method
+        """
+        return hasattr(self, f'values_{self.table_name}')
+
+    def load_table(self, batch_size: int = 1000, sort_rows: bool = False):
+        """
+        Bulk load the data from the csv text file into the table with LOAD DATA LOCAL INFILE.
+        The rows are converted as usual (apart from UUIDs, which the server converts with UNHEX)
+        and streamed to a temporary tab-separated file which the server then loads in one go.
+        Tables with bespoke conversion methods cannot be loaded this way.
+        If the server refuses to load local files, or skips or alters any row in loading them
+        (which, for a local file, it does with no more than a warning), the load is rolled back
+        and the table is populated with multi-row inserts instead, which reject bad rows outright.
+        :param batch_size: the number of rows in each multi-row insert should it be necessary to fall back
+        :param sort_rows: True if the rows are to be sorted into primary key order before they are loaded
+        """
+        column_names = self.column_names()
+        uuid_fields = self.table_metadata['uuid_fields']
+        columns = []
+        assignments = []
+        for (i, column_name) in enumerate(column_names):
+            if i in uuid_fields:
+                columns.append(f'@uuid_{i}')
+                assignments.append(f"`{column_name}` = unhex(replace(@uuid_{i}, '-', ''))")
+            else:
+                columns.append(f'`{column_name}`')
+        q = f"load data local infile %s into table {self.table_name} character set utf8mb4 "
+        q += "fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' "
+        q += f"({', '.join(columns)})"
+        if len(assignments) > 0:
+            q += f" set {', '.join(assignments)}"
+
+        # The temporary file is removed however the conversion or the load ends
+        load_file = tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, encoding='utf-8', newline='')
+        try:
+            try:
+                with open(self.data_filepath, newline='') as f, load_file:
+                    rows = (self.load_converter(row) for row in csv.reader(f, delimiter='\t'))
+                    if sort_rows:
+                        rows = sorted(rows, key=self.primary_key_order())
+                    for values in rows:
+                        load_file.write('\t'.join(self.load_data_field(value) for value in values) + '\n')
+            except FileNotFoundError:
+                self.env.msg.warning(
+                    f"Import file '{self.table_name}.csv' not found in '{self.table_metadata['group']}'"
+                )
+                return
+
+            c = self.env.dbc.cursor()
+            try:
+                c.execute(q, (load_file.name, ))
+                record_count = c.rowcount
+                # With LOCAL, the server skips duplicate keys and truncates bad values with only a warning
+                c.execute('SHOW WARNINGS')
+                warnings = c.fetchall()
+            except mysql.connector.errors.DatabaseError as e:
+                self.env.msg.warning([
+                    f"Unable to bulk load '{self.table_name}': {e.msg}",
+                    '--Falling back to multi-row inserts'
+                ])
+                self.env.dbc.rollback()
+                self.populate_table(batch_size, sort_rows)
+            else:
+                if len(warnings) > 0:
+                    self.env.dbc.rollback()
+                    self.env.msg.warning(
+                        [f"Bulk load of '{self.table_name}' rolled back: {len(warnings)} rows skipped or altered"] +
+                        [f'--{level} {code}: {message}' for (level, code, message) in warnings[:10]] +
+                        ['--Falling back to multi-row inserts']
+                    )
+                    self.populate_table(batch_size, sort_rows)
+                else:
+                    self.env.dbc.commit()
+                    self.env.msg.info(f"Records inserted into '{self.table_name}' table = {record_count}")
+            finally:
+                c.close()
+        finally:
+            load_file.close()
+            os.remove(load_file.name)
+
+    @staticmethod
+    def load_data_field(value) -> str:
+        """
+        Format a value for a LOAD DATA file: nulls are \\N and
+        backslashes, tabs and line breaks are escaped with a backslash.
+        """
+        if value is None:
+            return '\\N'
+        value = str(value)
+        if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+            value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        return value
+
+    def column_names(self) -> list:
+        return self.env.schema_catalogue.column_names(self.env.dbc, self.table_name)
+
+    def data_insert_statement(self, table_name: str = None):
+        """
+        :param table_name: the table to insert into, if not this one (a table with the same columns)
+        """
+        field_list = [f"`{x}`" for x in self.column_names()]
         col_names = ', '.join(field_list)
         placeholders = ', '.join(['%s'] * len(field_list))
-        return f'insert into {self.table_name} ({col_names}) values ({placeholders})'
+        return f'insert into {table_name or self.table_name} ({col_names}) values ({placeholders})'
 
     @staticmethod
     def index_name(display_name: str) -> str:
@@ -128,28 +917,48 @@ class Table(object):
         """
         return display_name
 
-    def value_conversions_import(self, row: list) -> list:
+    def value_conversions_import(self, row: list, convert_uuids: bool = True) -> list:
         """
         Return a modified CSV row depending upon the table's metadata
         :param row:
+        :param convert_uuids: False if UUID strings are to be left for the database server to convert
         :return:
         """
-        # Fields which can be null should be null if the field in the CSV is the empty string
-        for field in self.table_metadata['nullable_fields']:
-            if row[field] == '':
-                row[field] = None
+        if convert_uuids:
+            return self.import_converter(row)
+        return self.load_converter(row)
 
+    def compiled_import_converter(self, convert_uuids: bool = True):
+        """
+        Compile the table's metadata into a function which converts a CSV row for import.
+        The field lists are read from the metadata once, here, so that converting a row does nothing but convert it.
+        :param convert_uuids: False if UUID strings are to be left for the database server to convert
+        :return: A function which modifies a CSV row in place and returns it
+        """
+        # Fields which can be null should be null if the field in the CSV is the empty string
+        nullable_fields = tuple(self.table_metadata['nullable_fields'])
         # In the CSV, UUIDs are stored as UUID strings; these must be converted to bytes
-        for field in self.table_metadata['uuid_fields']:
-            row[field] = uuid.UUID(row[field]).bytes
-
+        uuid_fields = tuple(self.table_metadata['uuid_fields']) if convert_uuids else ()
         # Index names need to be generated according to the field's default indexing rules
         # At present the index_name field must be the field immediately before the display_name field
-        for field in self.table_metadata['indexible_names']:
-            entity_name = EntityName(row[field['field_id']], row[field['field_id'] - 1])
-            row[field['field_id'] - 1] = entity_name.index_name(field['special_index'])
+        indexible_fields = tuple(
+            (field['field_id'], field['field_id'] - 1, field['special_index'])
+            for field in self.table_metadata['indexible_names']
+        )
+        parsed_uuid = uuid.UUID
+        index_name = EntityName.cached_index_name
 
-        return row
+        def converter(row: list) -> list:
+            for field in nullable_fields:
+                if row[field] == '':
+                    row[field] = None
+            for field in uuid_fields:
+                row[field] = parsed_uuid(row[field]).bytes
+            for (field, index_field, special_index) in indexible_fields:
+                row[index_field] = index_name(row[field], row[index_field], special_index)
+            return row
+
+        return converter
 
     """
     If a bespoke import process is required (because, for example, the table format has changed) then
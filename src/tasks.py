@@ -1,10 +1,18 @@
 from src.exceptions import NPMException
-from src.environment import MyEnvironment
+from src.environment import MyEnvironment, WorkerEnvironment
+from src.import_state import ImportState
 from src.npadb_tables import NPADBTables
 from src.table import Table
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Union
 
+import contextlib
+import csv
+import mysql.connector.errors
 import os
+import re
 import subprocess
+import sys
 
 
 class BaseTask(object):
@@ -15,14 +23,40 @@ class BaseTask(object):
     def run(self):
         raise NPMException(f'{self.__class__.__name__} functionality not implemented.')
 
+    def selected_tables(self) -> dict:
+        """
+        The metadata of all the tables (the --all option) or of the tables named by the user (the --tables option).
+        Tables not in the schema are skipped with a warning.
+        :return: Table metadata keyed by table name
+        """
+        if self.env.args.all:
+            return dict(self.schema.data)
+        tables = {}
+        for table_name in self.env.args.tables:
+            try:
+                tables[table_name] = self.schema.table(table_name)
+            except NPMException as e:
+                self.env.msg.warning([
+                    f'Skipping {table_name}',
+                    f'--{e.args[0]}'
+                ])
+        return tables
+
 
 class ImportTask(BaseTask):
     def run(self):
+        if self.env.args.diff and self.env.args.format == 'binary':
+            raise NPMException('Changes can only be applied (--diff) from csv files')
+        # Most tables are rebuilt, and so reloaded after their DDL has been run, so none is loaded until it is used
+        self.env.schema_catalogue.load_individually()
+        self.import_state = ImportState(self.env)
         query = "SET FOREIGN_KEY_CHECKS = {}"
         c = self.env.dbc.cursor()
         c.execute(query.format(0))
 
-        if self.env.args.all:
+        if self.env.args.jobs > 1:
+            self.build_tables_in_parallel()
+        elif self.env.args.all:
             for table in self.schema.data.items():
                 self.build_this_table(*table)
         else:
@@ -38,52 +72,318 @@ class ImportTask(BaseTask):
         c.close()
         print()
 
-    def build_this_table(self, table_name: str, table_metadata: dict):
-        self.env.msg.info(f"Building table '{table_name}' from data in group '{table_metadata['group']}'")
+    def build_tables_in_parallel(self):
+        """
+        Build the tables on a pool of --jobs connections.
+        A table is not started until every table it references with a foreign key has been built;
+        tables which do not depend on one another are built at the same time.
+        """
+        from src.connection_pool import ConnectionPool
+        tables = self.selected_tables()
+        pending = {
+            table_name: self.table_dependencies(table_name, table_metadata) & (set(tables) - {table_name})
+            for (table_name, table_metadata) in tables.items()
+        }
+        pool = ConnectionPool(self.env, self.env.args.jobs, ['SET FOREIGN_KEY_CHECKS = 0'])
+        running = {}
+        try:
+            self.schedule_tables(pool, tables, pending, running)
+        finally:
+            pool.close()
+
+    def schedule_tables(self, pool, tables: dict, pending: dict, running: dict):
+        with ThreadPoolExecutor(self.env.args.jobs) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                ready = [table_name for (table_name, dependencies) in pending.items() if len(dependencies) == 0]
+                if len(ready) == 0 and len(running) == 0:
+                    # The remaining tables' foreign keys are circular: break the circle at the first of them
+                    ready = [next(iter(pending))]
+                    self.env.msg.warning(
+                        f"Circular foreign keys: building '{ready[0]}' before the tables it references"
+                    )
+                for table_name in ready:
+                    del pending[table_name]
+                    future = executor.submit(self.build_pooled_table, pool, table_name, tables[table_name])
+                    running[future] = table_name
+                (done, _) = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    table_name = running.pop(future)
+                    future.result()
+                    for dependencies in pending.values():
+                        dependencies.discard(table_name)
+
+    def build_pooled_table(self, pool, table_name: str, table_metadata: dict):
+        with pool.environment() as worker_env:
+            try:
+                self.build_this_table(table_name, table_metadata, worker_env)
+            except NPMException as e:
+                worker_env.msg.warning([
+                    f'Skipping {table_name}',
+                    f'--{e.args[0]}'
+                ])
+
+    def table_dependencies(self, table_name: str, table_metadata: dict) -> set:
+        """
+        :return: The names of the tables referenced by foreign keys in the table's DDL file
+        """
         table = Table(self.env, table_name, table_metadata)
-        self.env.msg.debug(table.ddl_filepath)
-        self.env.msg.debug(table.data_filepath)
-        if os.path.isfile(table.data_filepath):
-            table.create_table()
-            table.populate_table()
+        try:
+            with open(table.ddl_filepath, 'r') as f:
+                ddl = f.read()
+        except FileNotFoundError:
+            return set()
+        return set(re.findall(r'references\s+`?(\w+)`?', ddl, re.IGNORECASE))
+
+    def build_this_table(
+            self,
+            table_name: str,
+            table_metadata: dict,
+            env: Union[MyEnvironment, WorkerEnvironment, None] = None
+    ):
+        env = env or self.env
+        env.msg.info(f"Building table '{table_name}' from data in group '{table_metadata['group']}'")
+        table = Table(env, table_name, table_metadata)
+        env.msg.debug(table.ddl_filepath)
+        env.msg.debug(table.data_filepath)
+        if self.env.args.format == 'binary':
+            env.msg.debug(table.binary_export_filepath)
+            (data_filepath, data_group) = (table.binary_export_filepath, 'export')
         else:
-            self.env.msg.warning([
-                f"'{table_name}.csv' not found in '{table_metadata['group']}'",
+            (data_filepath, data_group) = (table.data_filepath, table_metadata['group'])
+        if os.path.isfile(data_filepath):
+            try:
+                content_hash = self.import_state.content_hash(
+                    table_name, table_metadata, table.ddl_filepath, data_filepath
+                )
+            except FileNotFoundError as e:
+                raise NPMException(e)
+            if self.is_unchanged(table, content_hash):
+                env.msg.info(f"Table '{table_name}' is unchanged since it was last built: skipped")
+                return
+            if self.env.args.diff and len(table.column_names()) > 0:
+                table.apply_diff(self.env.args.batch_size)
+            elif self.env.args.defer_indexes:
+                deferred_indexes = table.create_table(defer_indexes=True)
+                with table.bulk_load_session():
+                    self.load_this_table(table)
+                table.add_deferred_indexes(deferred_indexes)
+            else:
+                table.create_table()
+                self.load_this_table(table)
+            self.import_state.record(env, table_name, content_hash)
+        else:
+            env.msg.warning([
+                f"'{os.path.basename(data_filepath)}' not found in '{data_group}'",
                 'No changes have been made to the existing table structure or data.'
             ])
 
+    def is_unchanged(self, table: Table, content_hash: str) -> bool:
+        """
+        With --all (and without --force) a table which still exists need not be rebuilt
+        if its source files are those it was last built from.
+        """
+        return (
+            self.env.args.all
+            and not self.env.args.force
+            and self.import_state.is_unchanged(table.table_name, content_hash)
+            and len(table.column_names()) > 0
+        )
+
+    def load_this_table(self, table: Table):
+        if self.env.args.format == 'binary':
+            table.populate_table_binary(self.env.args.batch_size)
+        elif self.env.args.load_data and not table.has_bespoke_conversion():
+            table.load_table(self.env.args.batch_size, self.env.args.sort)
+        else:
+            table.populate_table(self.env.args.batch_size, self.env.args.sort)
+
 
 class ExportTask(BaseTask):
     def run(self):
         """
         Prepare to export the contents of all tables or list of specified tables
         (passed as arguments with the export task) to csv text files.
+        Tables whose checksums are those recorded in the export manifest when they were last exported
+        are skipped unless --force is given.
         :return:
         """
-        if self.env.args.all:
-            for table in self.schema.data.items():
-                self.export_this_table(*table)
+        if self.env.args.format == 'binary' and self.env.args.compress is not None:
+            raise NPMException('Binary exports cannot be compressed')
+        from src.export_manifest import ExportManifest
+        self.env.schema_catalogue.load(self.env.dbc)
+        tables = self.selected_tables()
+        manifest = ExportManifest(self.env)
+        checksums = manifest.checksums(list(tables.keys()))
+        if not self.env.args.force:
+            for table_name in list(tables.keys()):
+                export_filepath = self.exported_filepath(Table(self.env, table_name, tables[table_name]))
+                if manifest.is_unchanged(
+                        table_name, checksums[table_name], export_filepath, self.env.args.compress, self.env.args.format
+                ):
+                    self.env.msg.info(f"Table '{table_name}' is unchanged since it was last exported: skipped")
+                    del tables[table_name]
+        if self.env.args.jobs > 1:
+            exported = self.export_tables_in_parallel(tables)
         else:
-            for table_name in self.env.args.tables:
-                try:
-                    self.export_this_table(table_name, self.schema.table(table_name))
-                except NPMException as e:
-                    self.env.msg.warning([
-                        f'Skipping {table_name}',
-                        f'--{e.args[0]}'
-                    ])
+            exported = [
+                table_name for (table_name, table_metadata) in tables.items()
+                if self.export_this_table(table_name, table_metadata)
+            ]
+        for table_name in exported:
+            manifest.record(table_name, checksums[table_name], self.env.args.compress, self.env.args.format)
+        manifest.save()
+
+    def export_tables_in_parallel(self, tables: dict) -> list:
+        """
+        Export several tables at once on a pool of --jobs connections.
+        Every connection reads from its own consistent snapshot and all the snapshots are started together,
+        under a global read lock, so that the exported files represent the database at a single point in time.
+        Tables larger than --chunk-threshold rows are split into --chunks primary key ranges
+        which are exported at the same time to part files and then joined, in key order, into the export file.
+        Every table is planned, on a single connection, before any export starts
+        so that planning never waits on a connection held by an export.
+        If any part of a table fails, its other parts are removed and the table is not exported.
+        :param tables: Table metadata keyed by table name
+        :return: The names of the tables exported without error
+        """
+        from src.connection_pool import ConnectionPool
+        pool = ConnectionPool(self.env, self.env.args.jobs)
+        try:
+            self.start_consistent_snapshots(pool)
+            with ThreadPoolExecutor(self.env.args.jobs) as executor:
+                futures = {}
+                chunked_tables = []
+                with pool.environment() as worker_env:
+                    plans = {
+                        table_name: self.planned_chunks(Table(worker_env, table_name, table_metadata))
+                        for (table_name, table_metadata) in tables.items()
+                    }
+                for (table_name, table_metadata) in tables.items():
+                    chunks = plans[table_name]
+                    if chunks is None:
+                        futures[table_name] = executor.submit(
+                            self.export_pooled_table, pool, table_name, table_metadata
+                        )
+                        continue
+                    (key_column, ranges) = chunks
+                    self.env.msg.info(f"Exporting table '{table_name}' in {len(ranges)} parts")
+                    part_futures = [
+                        executor.submit(
+                            self.export_pooled_part, pool, table_name, table_metadata, part, key_column, lower, upper
+                        )
+                        for (part, (lower, upper)) in enumerate(ranges)
+                    ]
+                    chunked_tables.append((table_name, table_metadata, part_futures))
+                exported = [table_name for (table_name, future) in futures.items() if future.result()]
+                for (table_name, table_metadata, part_futures) in chunked_tables:
+                    for future in part_futures:
+                        future.result()
+        finally:
+            pool.close()
+        for (table_name, table_metadata, part_futures) in chunked_tables:
+            table = Table(self.env, table_name, table_metadata)
+            part_counts = [future.result() for future in part_futures]
+            if None in part_counts:
+                table.remove_parts(len(part_futures), self.env.args.compress)
+                self.env.msg.info(f"Records exported from '{table_name}' table = 0")
+                continue
+            table.concatenate_parts(len(part_futures), self.env.args.compress)
+            record_count = sum(part_counts)
+            self.env.msg.info(f"Records exported from '{table_name}' table = {record_count}")
+            exported.append(table_name)
+        return exported
 
-    def export_this_table(self, table_name: str, table_metadata: dict):
+    def planned_chunks(self, table: Table) -> Union[tuple, None]:
+        """
+        Decide whether a table is large enough to be exported in parts and, if so, plan the parts.
+        :return: None if the table is to be exported in one piece,
+        otherwise a tuple of the primary key column on which it is split and a list of (lower, upper) key ranges
+        """
+        if self.env.args.chunks < 2 or self.env.args.format == 'binary':
+            return None
+        row_count = table.estimated_row_count()
+        if row_count < self.env.args.chunk_threshold:
+            return None
+        key_column = table.primary_key_column()
+        if key_column is None:
+            return None
+        boundaries = table.chunk_boundaries(key_column, row_count, self.env.args.chunks)
+        if len(boundaries) == 0:
+            return None
+        return key_column, list(zip([None] + boundaries, boundaries + [None]))
+
+    def export_pooled_part(self, pool, table_name: str, table_metadata: dict, part: int, key_column: str, lower, upper):
+        """
+        :return: The number of rows exported or None if there was a database error
+        """
+        with pool.environment() as worker_env:
+            table = Table(worker_env, table_name, table_metadata)
+            try:
+                return table.export_part(
+                    part, key_column, lower, upper, self.env.args.batch_size, self.env.args.compress
+                )
+            except mysql.connector.errors.ProgrammingError as e:
+                self.env.msg.warning(f"Database Error: {e.msg}")
+                return None
+
+    def start_consistent_snapshots(self, pool):
+        """
+        Start a consistent snapshot transaction on every connection in the pool.
+        The global read lock stops anything being written while the snapshots are started.
+        If the lock cannot be obtained (it needs the RELOAD privilege) the snapshots are started anyway
+        but a write made while they are being started could be seen by some connections and not others.
+        """
+        c = self.env.dbc.cursor()
+        try:
+            c.execute('FLUSH TABLES WITH READ LOCK')
+        except mysql.connector.errors.DatabaseError as e:
+            self.env.msg.warning([
+                f'Unable to lock tables while starting the export snapshots: {e.msg}',
+                '--The exported tables may not represent a single point in time'
+            ])
+            locked = False
+        else:
+            locked = True
+        try:
+            for worker_env in pool.environments:
+                wc = worker_env.dbc.cursor()
+                wc.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                wc.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+                wc.close()
+        finally:
+            if locked:
+                c.execute('UNLOCK TABLES')
+            c.close()
+
+    def export_pooled_table(self, pool, table_name: str, table_metadata: dict) -> bool:
+        with pool.environment() as worker_env:
+            return self.export_this_table(table_name, table_metadata, worker_env)
+
+    def export_this_table(
+            self,
+            table_name: str,
+            table_metadata: dict,
+            env: Union[MyEnvironment, WorkerEnvironment, None] = None
+    ) -> bool:
         """
         Export the contents of a particular table to a csv text file.
         :param table_name:
         :param table_metadata:
-        :return:
+        :param env: the environment whose database connection is to be used, if not the main one
+        :return: True if the table was exported without error
         """
-        self.env.msg.info(f"Exporting table '{table_name}' from group '{table_metadata['group']}'")
-        table = Table(self.env, table_name, table_metadata)
-        self.env.msg.debug(table.export_filepath)
-        table.export()
+        env = env or self.env
+        env.msg.info(f"Exporting table '{table_name}' from group '{table_metadata['group']}'")
+        table = Table(env, table_name, table_metadata)
+        env.msg.debug(self.exported_filepath(table))
+        if self.env.args.format == 'binary':
+            return table.export_binary(self.env.args.batch_size)
+        return table.export(self.env.args.batch_size, self.env.args.compress)
+
+    def exported_filepath(self, table: Table) -> str:
+        if self.env.args.format == 'binary':
+            return table.binary_export_filepath
+        return table.compressed_export_filepath(self.env.args.compress)
 
 
 class ListTablesTask(BaseTask):
@@ -222,3 +522,83 @@ class PostCodeBuildTask(BaseTask):
         from src.code_point_open import CodePointOpen
         data = CodePointOpen(self.env)
         data.import_post_code_data()
+
+
+class NearestPostCodesTask(BaseTask):
+    def run(self):
+        """
+        Look up the post codes nearest to the points given on the command line and/or in a file.
+        Results are printed as tab-separated lines of easting, northing, post code and distance in metres.
+        """
+        if self.env.args.k < 1:
+            raise NPMException(f'Bad number of post codes {self.env.args.k}: it must be a positive integer')
+        if self.env.args.radius is not None and self.env.args.radius < 0:
+            raise NPMException(f'Bad radius {self.env.args.radius}: it must not be negative')
+        from src.post_code_locator import PostCodeLocator
+        filepath = PostCodeLocator.filepath(self.env)
+        if self.env.args.build:
+            post_code_count = PostCodeLocator.build(self.env)
+            self.env.msg.ok(f'Indexed {post_code_count:,} post codes in {filepath}')
+
+        points = [tuple(point) for point in self.env.args.point or []]
+        if self.env.args.file is not None:
+            try:
+                with open(self.env.args.file, newline='') as f:
+                    points += [(float(row[0]), float(row[1])) for row in csv.reader(f, delimiter='\t')]
+            except FileNotFoundError:
+                raise NPMException(f'Points file {self.env.args.file} not found.')
+        if len(points) == 0:
+            return
+
+        locator = PostCodeLocator(filepath)
+        if self.env.args.radius is None:
+            results = locator.nearest_batch(points, self.env.args.k)
+        else:
+            results = locator.within_batch(points, self.env.args.radius)
+        for ((x, y), found) in zip(points, results):
+            for (post_code, distance) in found:
+                print(f'{x:.0f}\t{y:.0f}\t{post_code}\t{distance:.0f}')
+        locator.close()
+
+
+class GeocodeTask(BaseTask):
+    def run(self):
+        """
+        Append the osx, osy, gr_source_id and district_id of each row's post code to a tab-separated file.
+        Lookups are made in the post code snapshot so no database queries are needed.
+        Rows with unknown post codes are passed through with empty fields appended.
+        """
+        if self.env.args.column < 1:
+            raise NPMException(f'Bad column {self.env.args.column}: it must be a positive integer')
+        from src.post_code_snapshot import PostCodeSnapshot
+        filepath = PostCodeSnapshot.filepath(self.env)
+        if self.env.args.snapshot:
+            post_code_count = PostCodeSnapshot.build(self.env)
+            self.env.msg.ok(f'Saved {post_code_count:,} post codes in {filepath}')
+        if self.env.args.file is None:
+            return
+
+        column = self.env.args.column - 1
+        unknown_count = 0
+        try:
+            with open(self.env.args.file, newline='') as f:
+                rows = list(csv.reader(f, delimiter='\t'))
+        except FileNotFoundError:
+            raise NPMException(f'Post codes file {self.env.args.file} not found.')
+        snapshot = PostCodeSnapshot(filepath)
+        try:
+            results = snapshot.lookup_batch(row[column] if len(row) > column else '' for row in rows)
+            if self.env.args.output is None:
+                output = contextlib.nullcontext(sys.stdout)
+            else:
+                output = open(self.env.args.output, 'w', newline='')
+            with output as f:
+                writer = csv.writer(f, delimiter='\t')
+                for (row, result) in zip(rows, results):
+                    if result is None:
+                        unknown_count += 1
+                        result = ('', '', '', '')
+                    writer.writerow(row + list(result))
+        finally:
+            snapshot.close()
+        self.env.msg.info(f'Post codes geocoded: {len(rows) - unknown_count:,}; not found: {unknown_count:,}')